@@ -0,0 +1,263 @@
+"""Offline benchmark for CurrenzBot handlers.
+
+Runs synthetic Telegram updates through the real handlers without a bot token
+or network access. Exchange rates come from a local stub server with
+configurable latency and replies go to a fake bot, so results are comparable
+across commits.
+
+Usage:
+    python benchmark.py [--requests 200] [--latency 0.05] [--no-cache]
+                        [--enforce-limits] [--json results.json]
+
+Pass several latencies (e.g. --latency 0.8,0.05) to start one stub provider
+per value and exercise hedged requests and failover.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Sample rates served by the stub server, relative to USD
+STUB_USD_RATES = {
+    "USD": 1.0, "EUR": 0.92, "GBP": 0.79, "JPY": 149.5, "CAD": 1.36,
+    "AUD": 1.52, "CHF": 0.88, "CNY": 7.24, "INR": 83.1, "BTC": 0.000016,
+    "HKD": 7.82, "NZD": 1.64, "SEK": 10.6, "KRW": 1330.0, "SGD": 1.35,
+    "NOK": 10.7, "MXN": 17.1, "BDT": 110.0, "ZAR": 18.9, "TRY": 32.1,
+}
+
+def make_stub_handler(latency):
+    """Build a request handler that mimics the open.er-api.com response schema."""
+
+    class StubRatesHandler(BaseHTTPRequestHandler):
+        """Serves /v6/latest/<BASE> after sleeping for `latency` seconds."""
+
+        def do_GET(self):
+            time.sleep(latency)
+            base = self.path.rstrip("/").rsplit("/", 1)[-1].upper()
+            if base in STUB_USD_RATES:
+                scale = STUB_USD_RATES[base]
+                body = {
+                    "result": "success",
+                    "base_code": base,
+                    "rates": {code: rate / scale for code, rate in STUB_USD_RATES.items()},
+                }
+            else:
+                body = {"result": "error", "error-type": "unsupported-code"}
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubRatesHandler
+
+def start_stub_server(latency):
+    """Start the stub rate server on a free local port and return it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_stub_handler(latency))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class FakeRetryAfter(Exception):
+    """Stand-in for telegram.error.RetryAfter."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Flood control exceeded. Retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+class FakeBot:
+    """Records Telegram API calls instead of sending them.
+
+    With `enforce_limits` it rejects calls that exceed Telegram's global and
+    per-chat limits the way the real API does, by raising a RetryAfter.
+    """
+
+    defaults = None
+
+    def __init__(self, enforce_limits=False, global_rate=30, chat_interval=1.0):
+        self.enforce_limits = enforce_limits
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.calls = 0
+        self.rejected = 0
+        self._window = []
+        self._last_by_chat = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _check_limits(self, chat_id):
+        """Raise FakeRetryAfter if this call would exceed a limit."""
+        now = time.monotonic()
+        self._window = [t for t in self._window if now - t < 1.0]
+        if len(self._window) >= self.global_rate:
+            self.rejected += 1
+            raise FakeRetryAfter(1)
+        last = self._last_by_chat.get(chat_id)
+        if last is not None and now - last < self.chat_interval * 0.5:
+            # Telegram tolerates short bursts per chat; reject clear abuse only
+            self.rejected += 1
+            raise FakeRetryAfter(1)
+        self._window.append(now)
+        self._last_by_chat[chat_id] = now
+
+    def _call(self, chat_id, text):
+        """Account for an API call and return a message object."""
+        from telegram import Chat, Message
+
+        with self._lock:
+            if self.enforce_limits:
+                self._check_limits(chat_id)
+            self.calls += 1
+            message_id = self._next_id
+            self._next_id += 1
+        return Message(message_id, datetime.datetime.now(), Chat(chat_id, "private"),
+                       text=text, bot=self)
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self._call(chat_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+        return self._call(chat_id, text)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return True
+
+def make_update(bot, update_id, user_id, text):
+    """Build a text-message Update from `user_id` bound to the fake bot."""
+    from telegram import Chat, Message, Update, User
+
+    user = User(user_id, f"User{user_id}", False, username=f"user{user_id}")
+    message = Message(update_id, datetime.datetime.now(), Chat(user_id, "private"),
+                      from_user=user, text=text, bot=bot)
+    return Update(update_id, message=message)
+
+def make_context(text):
+    """Build a minimal CallbackContext stand-in carrying command arguments."""
+    args = text.split()[1:] if text.startswith("/") else []
+    return SimpleNamespace(args=args, bot_data={}, user_data={}, chat_data={})
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def build_scenarios(bot_module):
+    """Handlers to benchmark and the message texts to feed them."""
+    return {
+        "rates_command": (bot_module.rates_command, ["/rates", "/rates EUR", "/rates GBP"]),
+        "compare_command": (bot_module.compare_command, ["/compare USD EUR GBP JPY", "/compare EUR INR"]),
+        "currencies_command": (bot_module.currencies_command, ["/currencies"]),
+        "handle_unknown": (bot_module.handle_unknown, ["100 USD to EUR", "convert 50 GBP into JPY", "hello"]),
+    }
+
+def drain(bot_module, timeout=120):
+    """Wait until the outbound queue is empty."""
+    deadline = time.monotonic() + timeout
+    while bot_module.outbound.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def run_benchmark(bot_module, requests_per_handler, enforce_limits, users):
+    """Run every scenario and return the per-handler results."""
+    results = {}
+    update_id = 1
+    for name, (handler, texts) in build_scenarios(bot_module).items():
+        bot = FakeBot(enforce_limits=enforce_limits)
+        wrapped = bot_module.instrument_handler(handler)
+        latencies = []
+        started = time.perf_counter()
+        for i in range(requests_per_handler):
+            text = texts[i % len(texts)]
+            update = make_update(bot, update_id, 1000 + random.randrange(users), text)
+            update_id += 1
+            t0 = time.perf_counter()
+            wrapped(update, make_context(text))
+            latencies.append(time.perf_counter() - t0)
+        handled = time.perf_counter() - started
+        drain(bot_module)
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            "requests": requests_per_handler,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "handled_per_sec": round(requests_per_handler / handled, 1),
+            "messages": bot.calls,
+            "messages_per_sec": round(bot.calls / elapsed, 1),
+            "api_calls_per_request": round(bot.calls / requests_per_handler, 2),
+            "rejected_by_limits": bot.rejected,
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline CurrenzBot handler benchmark")
+    parser.add_argument("--requests", type=int, default=200, help="updates per handler")
+    parser.add_argument("--latency", default="0.05",
+                        help="stub API latency in seconds; comma-separate for several providers")
+    parser.add_argument("--users", type=int, default=500, help="number of distinct simulated users")
+    parser.add_argument("--no-cache", action="store_true", help="disable the exchange rate cache")
+    parser.add_argument("--enforce-limits", action="store_true",
+                        help="make the fake bot reject calls over Telegram's rate limits")
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args()
+
+    servers = [start_stub_server(float(latency)) for latency in options.latency.split(",")]
+    urls = ["http://{}:{}/v6/latest/".format(*server.server_address) for server in servers]
+    os.environ["EXCHANGE_RATES_API_URL"] = urls[0]
+    os.environ["RATE_PROVIDERS"] = ",".join(f"open_er_api={url}" for url in urls[1:])
+    os.environ["TESTING"] = "1"
+    if options.no_cache:
+        os.environ["RATES_CACHE_TTL"] = "0"
+    if not options.enforce_limits:
+        # Measure the bot itself rather than the pacing of outbound messages
+        os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000000")
+        os.environ.setdefault("TELEGRAM_CHAT_BURST", "1000000")
+
+    json_path = os.path.abspath(options.json) if options.json else None
+
+    # Keep analytics writes away from the real data file
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    workdir = tempfile.mkdtemp(prefix="currenzbot-bench-")
+    os.chdir(workdir)
+
+    import logging
+    logging.disable(logging.WARNING)
+    import currenzbot_full as bot_module
+    bot_module.load_telegram()
+
+    results = run_benchmark(bot_module, options.requests, options.enforce_limits, options.users)
+    for server in servers:
+        server.shutdown()
+
+    header = f"{'handler':<20} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9} {'msg/s':>9} {'calls/req':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<20} {r['p50_ms']:>9} {r['p99_ms']:>9} {r['handled_per_sec']:>9} "
+              f"{r['messages_per_sec']:>9} {r['api_calls_per_request']:>10}")
+
+    print()
+    for name, status in bot_module.rate_providers.status().items():
+        print(f"provider {name}: {status}")
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({"options": vars(options), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,55 @@
+from __future__ import annotations
+
+import time
+_import_started = time.perf_counter()
+
 import os
 import json
 import logging
 import threading
 import datetime
-import time
 import re
+import io
+import csv
+import bisect
+import functools
+import heapq
+import itertools
+import random
+import hmac
+import tempfile
+import cProfile
+import pstats
+import gc
+import resource
+import tracemalloc
+import sqlite3
+import signal
+import queue
+import atexit
+import hashlib
+import abc
+from collections import defaultdict, deque, Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from logging.handlers import QueueHandler, QueueListener
+
+# Import-time breakdown, reported once the bot is ready
+STARTUP_TIMINGS = {"import_stdlib": time.perf_counter() - _import_started}
+_phase_started = time.perf_counter()
 import requests
-from collections import defaultdict, Counter
-from flask import Flask, render_template
+import requests.adapters
+STARTUP_TIMINGS["import_requests"] = time.perf_counter() - _phase_started
+_phase_started = time.perf_counter()
+from flask import Flask, Response, abort, jsonify, render_template, request
+STARTUP_TIMINGS["import_flask"] = time.perf_counter() - _phase_started
 
 # --- CONFIG SECTION ---
 # You can replace these with your actual credentials
 TELEGRAM_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN"  # Replace with your bot token
 WISE_REFERRAL_LINK = "https://wise.com/invite/dic/mdmonjuruli1"
+# Multi-tenant mode: path to a JSON list of bots to run in this process, each
+# {"name", "token", "wise_referral_link"?, "popular_currencies"?}
+BOTS_CONFIG = os.environ.get("BOTS_CONFIG")
 
 # Emoji dictionary
 EMOJI = {
@@ -43,16 +80,1122 @@ CURRENCY_SYMBOLS = {
     "BTC": "₿"
 }
 
+# The settings above can be overridden from this JSON file, which is re-read
+# on SIGHUP or POST /admin/reload-config (see the config reload module)
+CONFIG_FILE = os.environ.get("CONFIG_FILE", "currenzbot_config.json")
+
 # --- LOGGING SETUP ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Handler threads only put records on a queue; a listener thread formats and
+# writes them, so log I/O stays off the request path. Records are JSON by
+# default (LOG_FORMAT=text restores the plain format). High-frequency loggers
+# can be sampled with LOG_SAMPLING, e.g. "currenzbot_full.upstream=0.1";
+# warnings and errors are never sampled out.
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", f"{__name__}.upstream=0.1")
+LOG_USER_SALT = os.environ.get("LOG_USER_SALT", "currenzbot")
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Structured fields copied into JSON records when present
+LOG_CONTEXT_FIELDS = ("handler", "user", "latency", "cache_hit")
+
+@functools.lru_cache(maxsize=4096)
+def user_hash(user_id):
+    """Short salted hash identifying a user in logs without exposing the id."""
+    if user_id is None:
+        return None
+    return hashlib.sha256(f"{LOG_USER_SALT}:{user_id}".encode()).hexdigest()[:12]
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single JSON line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class LogContextFilter(logging.Filter):
+    """Tags records with the handler and user of the update being traced."""
+
+    def filter(self, record):
+        trace = getattr(_trace_state, "trace", None)
+        if trace is not None and not hasattr(record, "handler"):
+            record.handler = trace.handler
+            record.user = user_hash(trace.user_id)
+        return True
+
+class LogSampler(logging.Filter):
+    """Keeps a fraction of the records below WARNING for selected loggers."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+def parse_log_sampling(spec):
+    """Parse "logger=rate,..." into a dict, skipping malformed entries."""
+    rates = {}
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, _, rate = entry.partition("=")
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that defers formatting to the listener and never blocks.
+
+    Records are enqueued as-is (the stdlib handler formats them on the calling
+    thread first) and dropped when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# The queue handler exists from import so its metrics can be registered;
+# setup_logging() attaches it and starts the listener
+log_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_handler.addFilter(LogSampler(parse_log_sampling(LOG_SAMPLING)))
+log_handler.addFilter(LogContextFilter())
+log_listener = None
+_logging_lock = threading.Lock()
+
+def setup_logging():
+    """Route the root logger through the queue, drained by a listener thread.
+
+    Called by main() and create_application() rather than on import, and
+    it adds to the root handlers instead of replacing them, so importing
+    this module leaves the host's logging alone. Safe to call again.
+    """
+    global log_listener
+    with _logging_lock:
+        if log_listener is not None:
+            return log_listener
+        stream = logging.StreamHandler()
+        stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+        root = logging.getLogger()
+        root.addHandler(log_handler)
+        root.setLevel(LOG_LEVEL)
+        log_listener = QueueListener(log_handler.queue, stream, respect_handler_level=True)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        return log_listener
+
+# Trace of the update being handled on each thread, see the tracing module
+_trace_state = threading.local()
 logger = logging.getLogger(__name__)
+# Per-request lines that are worth sampling under load
+upstream_logger = logging.getLogger(f"{__name__}.upstream")
+access_logger = logging.getLogger(f"{__name__}.access")
+
+# --- STARTUP MODULE ---
+# With LAZY_STARTUP=1 the Telegram stack is only imported when the bot is
+# created and analytics load in the background, so a gunicorn worker serving
+# only the Flask app starts quickly.
+LAZY_STARTUP = os.environ.get("LAZY_STARTUP") == "1"
+
+def record_startup_phase(phase, started):
+    """Record how long a startup phase took, given its perf_counter start."""
+    STARTUP_TIMINGS[phase] = time.perf_counter() - started
+
+def mark_ready(component):
+    """Record the time from the start of the import until `component` is ready."""
+    STARTUP_TIMINGS[f"ready_{component}"] = time.perf_counter() - _import_started
+    summary = ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in STARTUP_TIMINGS.items())
+    logger.info("Startup timings: %s", summary)
+
+# --- METRICS MODULE ---
+# Minimal Prometheus-compatible metrics, kept dependency-free. Each metric
+# holds its series in a dict keyed by label values, so recording a sample is
+# a dict lookup plus a few additions under a lock.
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=None):
+    """Render a label set in the Prometheus text format."""
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+class MetricCounter:
+    """Monotonically increasing counter."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Increase the counter for the given label values."""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """Current value for the given label values."""
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        """Yield the exposition lines for this counter."""
+        with self._lock:
+            items = list(self._values.items())
+        for values, value in items:
+            yield f"{self.name}{_format_labels(self.labels, values)} {value}"
+
+class Histogram:
+    """Cumulative histogram with fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Record one observation."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts, then +Inf, sum and count
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *label_values):
+        """Context manager that observes the elapsed wall time."""
+        return _HistogramTimer(self, label_values)
+
+    def render(self):
+        """Yield the exposition lines for this histogram."""
+        with self._lock:
+            items = [(values, list(series)) for values, series in self._series.items()]
+        for values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labels, values, ('le', le))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, values)} {series[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labels, values)} {series[-1]}"
+
+class _HistogramTimer:
+    """Times a block of code into a histogram."""
+
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time.
+
+    With `label` set, the callback returns a dict mapping label values to
+    values and one series is rendered per entry.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func, label=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.label = label
+
+    def render(self):
+        """Yield the exposition lines for this gauge."""
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.error("Error reading gauge %s: %s", self.name, e)
+            return
+        if value is None:
+            return
+        if self.label is None:
+            yield f"{self.name} {value}"
+            return
+        for label_value, v in list(value.items()):
+            yield f"{self.name}{_format_labels((self.label,), (label_value,))} {v}"
+
+class MetricsRegistry:
+    """Holds all metrics and renders them for the /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        """Add a metric, reusing an existing one with the same name."""
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labels=()):
+        """Create or get a counter."""
+        return self._register(MetricCounter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        """Create or get a histogram."""
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, func, label=None):
+        """Create or replace a callback gauge."""
+        self._metrics[name] = Gauge(name, help_text, func, label)
+        return self._metrics[name]
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HANDLER_LATENCY = metrics.histogram(
+    "currenzbot_handler_duration_seconds", "Time spent in Telegram handlers", ("handler",))
+HANDLER_REQUESTS = metrics.counter(
+    "currenzbot_handler_requests_total", "Telegram updates handled", ("handler", "status"))
+UPSTREAM_LATENCY = metrics.histogram(
+    "currenzbot_upstream_request_duration_seconds", "Exchange rate API request latency", ("provider",))
+UPSTREAM_REQUESTS = metrics.counter(
+    "currenzbot_upstream_requests_total", "Exchange rate API requests", ("provider", "status"))
+UPSTREAM_HEDGES = metrics.counter(
+    "currenzbot_upstream_extra_requests_total", "Requests sent to a second provider", ("reason",))
+RATE_CACHE_LOOKUPS = metrics.counter(
+    "currenzbot_rate_cache_lookups_total", "Exchange rate cache lookups", ("result",))
+RATE_LIMITED = metrics.counter(
+    "currenzbot_rate_limited_total", "Updates dropped by the per-user and per-chat limiter", ("scope",))
+TELEGRAM_API_CALLS = metrics.counter(
+    "currenzbot_telegram_api_calls_total", "Telegram API calls queued, by handler", ("handler",))
+REQUEST_LATENCY = metrics.histogram(
+    "currenzbot_request_duration_seconds",
+    "Time from receiving an update until its handler returned and all its sends finished", ("handler",))
+REPLY_LATENCY = metrics.histogram(
+    "currenzbot_reply_latency_seconds", "Time from receiving an update to delivering its answer", ("handler",))
+ANALYTICS_FLUSH_LATENCY = metrics.histogram(
+    "currenzbot_analytics_flush_duration_seconds", "Time spent writing the analytics file")
+metrics.gauge("currenzbot_startup_seconds", "Duration of startup phases",
+              lambda: dict(STARTUP_TIMINGS), label="phase")
+metrics.gauge("currenzbot_log_queue_depth", "Log records waiting to be written",
+              log_handler.queue.qsize)
+metrics.gauge("currenzbot_log_records_dropped", "Log records dropped because the queue was full",
+              lambda: log_handler.dropped)
+
+# --- TRACING MODULE ---
+# Per-request spans showing where a handler spent its time (upstream, analytics,
+# message building, Telegram sends), a slow-request log and an optional
+# sampling profiler.
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", 2.0))
+SLOW_LOG_FILE = os.environ.get("SLOW_LOG_FILE")
+# Fraction of handler calls to run under cProfile (0 disables profiling)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+slow_requests = deque(maxlen=100)
+
+class RequestTrace:
+    """Spans recorded while handling a single update.
+
+    `duration` is the time spent in the handler itself. Replies are sent
+    afterwards by the outbound queue, so the trace is only complete, with
+    `total` set, once the handler has returned and its last send finished.
+    """
+
+    __slots__ = ("handler", "user_id", "started", "duration", "total", "spans", "cache_hit",
+                 "pending_sends", "_lock")
+
+    def __init__(self, handler, user_id=None):
+        self.handler = handler
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.duration = None
+        self.total = None
+        self.spans = []
+        # None until rates are looked up; False once any lookup missed
+        self.cache_hit = None
+        self.pending_sends = 0
+        self._lock = threading.Lock()
+
+    def begin_send(self):
+        """Keep the trace open until a matching end_send()."""
+        with self._lock:
+            self.pending_sends += 1
+
+    def end_send(self):
+        """Mark a send finished; completes the trace if it was the last one."""
+        with self._lock:
+            self.pending_sends -= 1
+            done = self._mark_complete()
+        if done:
+            complete_trace(self)
+
+    def _mark_complete(self):
+        """Set `total` if nothing is outstanding; True the first time it is set."""
+        if self.duration is None or self.pending_sends or self.total is not None:
+            return False
+        self.total = time.perf_counter() - self.started
+        return True
+
+    def note_cache_lookup(self, hit):
+        """Record a rate cache lookup; one miss marks the whole request a miss."""
+        if self.cache_hit is not False:
+            self.cache_hit = hit
+
+    def record(self, name, duration):
+        """Add a finished span."""
+        self.spans.append((name, duration))
+
+    def phase_totals(self):
+        """Total time per span name."""
+        totals = defaultdict(float)
+        for name, duration in self.spans:
+            totals[name] += duration
+        return dict(totals)
+
+    def to_dict(self):
+        """Summary used for the slow log."""
+        return {
+            "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "handler": self.handler,
+            "user_id": self.user_id,
+            "duration": round(self.total or 0.0, 4),
+            "handler_duration": round(self.duration or 0.0, 4),
+            "phases": {k: round(v, 4) for k, v in self.phase_totals().items()},
+        }
+
+def current_trace():
+    """The trace of the update being handled on this thread, if any."""
+    return getattr(_trace_state, "trace", None)
+
+class trace_span:
+    """Context manager recording a span on the current trace (no-op without one)."""
+
+    __slots__ = ("name", "trace", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current_trace()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            self.trace.record(self.name, time.perf_counter() - self.started)
+        return False
+
+def start_trace(handler, user_id=None):
+    """Begin tracing an update on this thread."""
+    trace = RequestTrace(handler, user_id)
+    _trace_state.trace = trace
+    return trace
+
+def finish_trace(trace):
+    """End the handler part of a trace; it completes once its sends are done."""
+    _trace_state.trace = None
+    with trace._lock:
+        trace.duration = time.perf_counter() - trace.started
+        done = trace._mark_complete()
+    if done:
+        complete_trace(trace)
+
+def complete_trace(trace):
+    """Record a finished request and write a slow log entry if it crossed the threshold."""
+    REQUEST_LATENCY.observe(trace.total, trace.handler)
+    if trace.total >= SLOW_REQUEST_THRESHOLD:
+        entry = trace.to_dict()
+        slow_requests.append(entry)
+        logger.warning("Slow request: %s", entry)
+        if SLOW_LOG_FILE:
+            try:
+                with open(SLOW_LOG_FILE, 'a') as f:
+                    f.write(json.dumps(entry) + "\n")
+            except Exception as e:
+                logger.error("Error writing slow log: %s", e)
+
+class SamplingProfiler:
+    """Runs a random sample of handler calls under cProfile and aggregates the stats."""
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.stats = None
+        self.samples = 0
+        self._lock = threading.Lock()
+        # cProfile can only profile one call at a time reliably
+        self._busy = threading.Lock()
+
+    def run(self, func, *args):
+        """Call `func(*args)`, profiling it if it was sampled."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return func(*args)
+        if not self._busy.acquire(blocking=False):
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self._busy.release()
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+                self.samples += 1
+
+    def report(self, limit=50):
+        """Text report sorted by cumulative time."""
+        with self._lock:
+            if self.stats is None:
+                return "No profile samples collected yet.\n"
+            buffer = io.StringIO()
+            self.stats.stream = buffer
+            self.stats.sort_stats("cumulative").print_stats(limit)
+            return f"Samples: {self.samples}\n" + buffer.getvalue()
+
+    def dump(self):
+        """Aggregated stats in the binary pstats format, or None."""
+        with self._lock:
+            if self.stats is None:
+                return None
+            with tempfile.NamedTemporaryFile(suffix=".pstats") as f:
+                self.stats.dump_stats(f.name)
+                f.seek(0)
+                return f.read()
+
+    def reset(self):
+        """Drop all collected samples."""
+        with self._lock:
+            self.stats = None
+            self.samples = 0
+
+profiler = SamplingProfiler()
+
+# --- MEMORY MODULE ---
+# RSS sampling, tracemalloc snapshots and a soft memory limit. Modules that
+# keep long-lived structures register a size callback for the diagnostics
+# route and, where they can shed data, an eviction hook for memory pressure.
+MEMORY_SOFT_LIMIT_MB = float(os.environ.get("MEMORY_SOFT_LIMIT_MB", 0))
+MEMORY_SAMPLE_INTERVAL = int(os.environ.get("MEMORY_SAMPLE_INTERVAL", 60))
+MEMORY_TRACE = os.environ.get("MEMORY_TRACE") == "1"
+
+if MEMORY_TRACE:
+    tracemalloc.start(int(os.environ.get("MEMORY_TRACE_FRAMES", 1)))
+
+def get_rss_mb():
+    """Resident set size of this process in megabytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Peak RSS is the best we can do without procfs (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class MemoryMonitor:
+    """Samples RSS periodically and reacts when it crosses the soft limit."""
+
+    def __init__(self, soft_limit_mb=MEMORY_SOFT_LIMIT_MB, interval=MEMORY_SAMPLE_INTERVAL):
+        self.soft_limit_mb = soft_limit_mb
+        self.interval = interval
+        self.history = deque(maxlen=1440)
+        self.structures = {}
+        self.pressure_hooks = []
+        self.evictions = 0
+        self.last_snapshot = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def register_structure(self, name, size_func):
+        """Report `size_func()` as the size of a named in-memory structure."""
+        self.structures[name] = size_func
+
+    def register_pressure_hook(self, hook):
+        """Call `hook()` to shed memory when the soft limit is exceeded."""
+        self.pressure_hooks.append(hook)
+
+    def structure_sizes(self):
+        """Current size of every registered structure."""
+        sizes = {}
+        for name, size_func in self.structures.items():
+            try:
+                sizes[name] = size_func()
+            except Exception as e:
+                sizes[name] = f"error: {e}"
+        return sizes
+
+    def sample(self):
+        """Record the current RSS and relieve memory pressure if needed."""
+        rss = get_rss_mb()
+        self.history.append((datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), round(rss, 1)))
+        if self.soft_limit_mb and rss > self.soft_limit_mb:
+            logger.warning("RSS %.1f MB is over the soft limit of %s MB", rss, self.soft_limit_mb)
+            self.relieve_pressure()
+        return rss
+
+    def relieve_pressure(self):
+        """Run every eviction hook, then let the garbage collector return memory."""
+        for hook in self.pressure_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error("Error in memory pressure hook %s: %s", hook, e)
+        gc.collect()
+        self.evictions += 1
+
+    def top_allocations(self, limit=20):
+        """Largest allocation sites according to tracemalloc."""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        return [str(stat) for stat in snapshot.statistics("lineno")[:limit]]
+
+    def snapshot_diff(self, limit=20):
+        """Take a tracemalloc snapshot and compare it with the previous one."""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        with self._lock:
+            previous, self.last_snapshot = self.last_snapshot, snapshot
+        if previous is None:
+            return []
+        return [str(stat) for stat in snapshot.compare_to(previous, "lineno")[:limit]]
+
+    def start(self):
+        """Start the background sampling thread unless it is already running."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="memory-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """Sampling loop."""
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error("Error sampling memory: %s", e)
+            time.sleep(self.interval)
+
+# Started by create_application, or by the first web request in a gunicorn
+# worker, so merely importing the module starts no thread
+memory_monitor = MemoryMonitor()
+
+# --- STORAGE MODULE ---
+# Shared state (analytics, /convert wizard state, exchange rates) goes
+# through a StateBackend. The default ("memory") keeps everything in this
+# process, as before. The "sqlite" backend stores it in a local database file
+# so several gunicorn workers or bot processes on one host share state safely.
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "currenzbot_state.db")
+# How long a deleted row is kept as a tombstone so readers of changes() see it (seconds)
+TOMBSTONE_TTL = 86400
+
+class StateBackend(abc.ABC):
+    """Key-value storage for JSON-serializable values, grouped by namespace.
+
+    `ttl` is in seconds; expired values read as missing. `update` applies a
+    function to the current value atomically and stores the result. `shared`
+    tells whether other processes see the values and they outlive this one.
+    """
+
+    shared = False
+
+    @abc.abstractmethod
+    def get(self, namespace, key):
+        """The live value for a key, or None."""
+
+    @abc.abstractmethod
+    def set(self, namespace, key, value, ttl=None):
+        """Store a value."""
+
+    @abc.abstractmethod
+    def delete(self, namespace, key):
+        """Remove a key."""
+
+    @abc.abstractmethod
+    def update(self, namespace, key, func, ttl=None):
+        """Atomically replace a value with `func(current)` and return it."""
+
+    @abc.abstractmethod
+    def update_many(self, namespace, keys, func):
+        """Atomically read `keys` and write the dict returned by `func(values)`.
+
+        A written value of None deletes the key. Returns the writes.
+        """
+
+    @abc.abstractmethod
+    def changes(self, namespace, since=0):
+        """Rows written after version `since` as ([(key, value)], latest version).
+
+        Deleted keys are reported with a value of None.
+        """
+
+    @abc.abstractmethod
+    def purge_expired(self):
+        """Drop expired values."""
+
+    @abc.abstractmethod
+    def count(self, namespace):
+        """Number of live keys stored in a namespace."""
+
+    @abc.abstractmethod
+    def trim(self, namespace, max_keys):
+        """Drop the least recently written keys of a namespace beyond `max_keys`."""
+
+class MemoryBackend(StateBackend):
+    """Stores values in this process only.
+
+    Values are kept as JSON text, so as with SQLite a caller gets a copy and
+    cannot change a stored value by mutating it. Each namespace keeps its
+    keys in write order, oldest first.
+    """
+
+    def __init__(self):
+        # namespace -> {key: (JSON text, expires or None, version)}
+        self._namespaces = defaultdict(dict)
+        self._version = 0
+        self._lock = threading.RLock()
+
+    def _read(self, namespace, key, now):
+        entry = self._namespaces[namespace].get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+            return None
+        return json.loads(entry[0])
+
+    def _write(self, namespace, key, value, ttl):
+        keys = self._namespaces[namespace]
+        self._version += 1
+        # Re-insert so the key moves to the end of the write order
+        keys.pop(key, None)
+        keys[key] = (json.dumps(value), time.time() + ttl if ttl else None, self._version)
+
+    def get(self, namespace, key):
+        with self._lock:
+            return self._read(namespace, str(key), time.time())
+
+    def set(self, namespace, key, value, ttl=None):
+        with self._lock:
+            self._write(namespace, str(key), value, ttl)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._namespaces[namespace].pop(str(key), None)
+
+    def update(self, namespace, key, func, ttl=None):
+        with self._lock:
+            value = func(self._read(namespace, str(key), time.time()))
+            self._write(namespace, str(key), value, ttl)
+            return value
+
+    def update_many(self, namespace, keys, func):
+        with self._lock:
+            now = time.time()
+            writes = func({key: self._read(namespace, key, now) for key in keys})
+            for key, value in writes.items():
+                # Deleted keys stay behind as tombstones for changes()
+                self._write(namespace, key, value, TOMBSTONE_TTL if value is None else None)
+            return writes
+
+    def changes(self, namespace, since=0):
+        now = time.time()
+        with self._lock:
+            rows = sorted(
+                (version, key, text) for key, (text, expires, version) in self._namespaces[namespace].items()
+                if version > since and (expires is None or expires > now)
+            )
+        latest = rows[-1][0] if rows else since
+        return [(key, json.loads(text)) for _, key, text in rows], latest
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for keys in self._namespaces.values():
+                for key in [k for k, e in keys.items() if e[1] is not None and e[1] <= now]:
+                    del keys[key]
+
+    def count(self, namespace):
+        now = time.time()
+        with self._lock:
+            return sum(1 for text, expires, _ in self._namespaces[namespace].values()
+                       if text != "null" and (expires is None or expires > now))
+
+    def trim(self, namespace, max_keys):
+        with self._lock:
+            keys = self._namespaces[namespace]
+            while len(keys) > max_keys:
+                del keys[next(iter(keys))]
+
+class SQLiteBackend(StateBackend):
+    """Stores values in an SQLite database shared by all processes on the host.
+
+    Each thread gets its own connection. The database runs in WAL mode so
+    readers do not block the writer, and `update` takes the write lock up
+    front (BEGIN IMMEDIATE) so concurrent read-modify-write cycles from
+    different processes cannot lose updates. Every write gets a new version
+    number, so readers can fetch only what changed since their last read.
+    """
+
+    shared = True
+
+    def __init__(self, path=STATE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires REAL, PRIMARY KEY (namespace, key))"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(kv)")]
+            if "version" not in columns:
+                conn.execute("ALTER TABLE kv ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_version ON kv (version)")
+
+    def _connect(self):
+        """Get this thread's connection."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _read(self, conn, namespace, key):
+        row = conn.execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, conn, namespace, key, value, ttl):
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, expires, version)"
+            " VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM kv))",
+            (namespace, key, json.dumps(value), time.time() + ttl if ttl else None)
+        )
+
+    def get(self, namespace, key):
+        return self._read(self._connect(), namespace, str(key))
+
+    def set(self, namespace, key, value, ttl=None):
+        self._write(self._connect(), namespace, str(key), value, ttl)
+
+    def delete(self, namespace, key):
+        self._connect().execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+    def update(self, namespace, key, func, ttl=None):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = func(self._read(conn, namespace, str(key)))
+            self._write(conn, namespace, str(key), value, ttl)
+            conn.execute("COMMIT")
+            return value
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def update_many(self, namespace, keys, func):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            writes = func({key: self._read(conn, namespace, key) for key in keys})
+            for key, value in writes.items():
+                # Deleted keys stay behind as tombstones for changes()
+                self._write(conn, namespace, key, value, TOMBSTONE_TTL if value is None else None)
+            conn.execute("COMMIT")
+            return writes
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def changes(self, namespace, since=0):
+        rows = self._connect().execute(
+            "SELECT key, value, version FROM kv WHERE namespace = ? AND version > ?"
+            " AND (expires IS NULL OR expires > ?) ORDER BY version",
+            (namespace, since, time.time())
+        ).fetchall()
+        latest = rows[-1][2] if rows else since
+        return [(key, json.loads(value)) for key, value, _ in rows], latest
+
+    def purge_expired(self):
+        self._connect().execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+    def count(self, namespace):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM kv WHERE namespace = ? AND value != 'null'"
+            " AND (expires IS NULL OR expires > ?)",
+            (namespace, time.time())
+        ).fetchone()[0]
+
+    def trim(self, namespace, max_keys):
+        self._connect().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key IN (SELECT key FROM kv WHERE namespace = ?"
+            " ORDER BY version DESC LIMIT -1 OFFSET ?)",
+            (namespace, namespace, max_keys)
+        )
+
+def create_backend(kind=STATE_BACKEND):
+    """Create the configured state backend."""
+    if kind == "sqlite":
+        logger.info("Using SQLite state backend at %s", STATE_DB_PATH)
+        return SQLiteBackend(STATE_DB_PATH)
+    if kind != "memory":
+        logger.error("Unknown STATE_BACKEND %r, using memory", kind)
+    return MemoryBackend()
+
+storage = create_backend()
+memory_monitor.register_pressure_hook(storage.purge_expired)
 
 # --- CURRENCY MODULE ---
 # Exchange rates API URL
-EXCHANGE_RATES_API_URL = "https://open.er-api.com/v6/latest/"
+EXCHANGE_RATES_API_URL = os.environ.get("EXCHANGE_RATES_API_URL", "https://open.er-api.com/v6/latest/")
+
+# Extra rate sources as comma-separated kind=url pairs, tried in order after
+# the main API, e.g. "frankfurter=https://api.frankfurter.app/latest?from={base}".
+# A URL without {base} gets the base currency appended.
+RATE_PROVIDERS = os.environ.get("RATE_PROVIDERS", "")
+
+# Overall time budget for getting rates from any provider (seconds)
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 10))
+# Hedge delay used until a provider has enough latency samples (seconds);
+# low enough that the first requests after startup are hedged too
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 0.3))
+# Share of fetches that try the runner-up provider first to keep its stats fresh
+PROVIDER_EXPLORE_RATE = float(os.environ.get("PROVIDER_EXPLORE_RATE", 0.02))
+# An unhealthy provider is tried first again once it has not been asked for
+# this long, so it can recover wherever it ranks (seconds)
+PROVIDER_PROBE_INTERVAL = float(os.environ.get("PROVIDER_PROBE_INTERVAL", 30))
+
+# How long fetched rates are reused before asking the API again (seconds)
+RATES_CACHE_TTL = int(os.environ.get("RATES_CACHE_TTL", 300))
+
+# Upstream request budget: UPSTREAM_QUOTA calls per UPSTREAM_QUOTA_WINDOW
+# seconds (0 only counts). As the budget runs low, cached rates are kept
+# longer, then rates for other bases are derived from cached anchor
+# currencies instead of being fetched.
+UPSTREAM_QUOTA = int(os.environ.get("UPSTREAM_QUOTA", 0))
+UPSTREAM_QUOTA_WINDOW = int(os.environ.get("UPSTREAM_QUOTA_WINDOW", 30 * 86400))
+# Where the count is kept when the state backend is not shared
+UPSTREAM_QUOTA_FILE = 'upstream_quota.db'
+# Longest the cache TTL may be stretched, as a multiple of RATES_CACHE_TTL
+QUOTA_MAX_TTL_STRETCH = float(os.environ.get("QUOTA_MAX_TTL_STRETCH", 12))
+# Share of the budget used after which non-anchor bases are derived
+QUOTA_DERIVE_AT = float(os.environ.get("QUOTA_DERIVE_AT", 0.8))
+# How long a computed budget report is reused before the count is re-read (seconds)
+QUOTA_STATUS_INTERVAL = float(os.environ.get("QUOTA_STATUS_INTERVAL", 1.0))
+RATE_ANCHORS = [c.strip().upper() for c in os.environ.get("RATE_ANCHORS", "USD,EUR").split(",") if c.strip()]
+
+# Shared HTTP connection pool for all upstream requests
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+http_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+upstream_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="upstream")
+
+def parse_open_er_api(data, base_currency):
+    """Rates from an open.er-api.com response."""
+    if data.get('result') == 'success':
+        return data.get('rates', {})
+    logger.error("API error: %s", data.get('error-type') or data.get('error'))
+    return None
+
+def parse_frankfurter(data, base_currency):
+    """Rates from a frankfurter.app response, which omits the base itself."""
+    rates = data.get('rates')
+    if not rates:
+        logger.error("API error: %s", data.get('message'))
+        return None
+    rates = dict(rates)
+    rates[data.get('base', base_currency)] = 1.0
+    return rates
+
+def parse_exchangerate_host(data, base_currency):
+    """Rates from an exchangerate.host style response."""
+    if data.get('success', True) and data.get('rates'):
+        return data['rates']
+    logger.error("API error: %s", data.get('error'))
+    return None
+
+PROVIDER_PARSERS = {
+    "open_er_api": parse_open_er_api,
+    "frankfurter": parse_frankfurter,
+    "exchangerate_host": parse_exchangerate_host,
+}
+
+class RateProvider:
+    """One exchange rate API, normalized to a {currency: rate} dict.
+
+    Keeps a window of recent latencies and outcomes, which is used to rank
+    providers and to decide when to hedge.
+    """
+
+    def __init__(self, name, url, parser, window=100):
+        self.name = name
+        self.url = url if "{base}" in url else url + "{base}"
+        self.parser = parser
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.last_attempt = 0.0
+
+    def fetch(self, base_currency):
+        """Request rates for `base_currency`; returns None on any failure."""
+        url = self.url.format(base=base_currency)
+        self.last_attempt = time.monotonic()
+        started = time.perf_counter()
+        rates = None
+        try:
+            upstream_logger.info("Requesting URL: %s", url)
+            response = http_session.get(url, timeout=UPSTREAM_TIMEOUT)
+            if response.status_code == 200:
+                rates = self.parser(response.json(), base_currency)
+            else:
+                logger.error("HTTP error from %s: %s", self.name, response.status_code)
+        except Exception as e:
+            logger.error("Error getting exchange rates from %s: %s", self.name, e)
+        elapsed = time.perf_counter() - started
+        status = "success" if rates else "error"
+        upstream_quota.record(self.name)
+        if rates:
+            self.latencies.append(elapsed)
+        self.outcomes.append(bool(rates))
+        UPSTREAM_LATENCY.observe(elapsed, self.name)
+        UPSTREAM_REQUESTS.inc(self.name, status)
+        return rates
+
+    def p95(self):
+        """95th percentile of recent successful latencies, or None."""
+        if len(self.latencies) < 5:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, int(round(0.95 * len(ordered))) - 1))
+        return ordered[index]
+
+    def hedge_delay(self):
+        """How long to wait for this provider before asking another one."""
+        return self.p95() or HEDGE_DEFAULT_DELAY
+
+    def error_rate(self):
+        """Fraction of recent requests that failed."""
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def is_healthy(self):
+        """A provider is healthy while fewer than half its recent requests failed."""
+        return self.error_rate() < 0.5
+
+class ProviderPool:
+    """The configured rate providers, ranked by health and latency."""
+
+    def __init__(self, providers):
+        self.providers = providers
+
+    def ranked(self):
+        """Healthy providers first, fastest first; ties keep configured order.
+
+        Providers without enough samples rank as fastest so every source gets
+        measured, and now and then the runner-up is tried first so the stats
+        of slower sources do not go stale. An unhealthy provider that has not
+        been asked for PROVIDER_PROBE_INTERVAL is moved to the front once, so
+        it gets a chance to recover however low it ranks.
+        """
+        ranked = sorted(
+            self.providers,
+            key=lambda p: (not p.is_healthy(), p.p95() or 0.0)
+        )
+        now = time.monotonic()
+        due = [p for p in ranked
+               if not p.is_healthy() and now - p.last_attempt >= PROVIDER_PROBE_INTERVAL]
+        if due:
+            probe = min(due, key=lambda p: p.last_attempt)
+            # Claim the probe so concurrent lookups do not all try it
+            probe.last_attempt = now
+            ranked.remove(probe)
+            ranked.insert(0, probe)
+        elif len(ranked) > 1 and random.random() < PROVIDER_EXPLORE_RATE:
+            ranked[0], ranked[1] = ranked[1], ranked[0]
+        return ranked
+
+    def status(self):
+        """Per-provider health summary."""
+        return {
+            p.name: {
+                "healthy": p.is_healthy(),
+                "error_rate": round(p.error_rate(), 3),
+                "p95_seconds": p.p95(),
+            }
+            for p in self.providers
+        }
+
+def build_rate_providers(spec=RATE_PROVIDERS):
+    """Create the provider pool from EXCHANGE_RATES_API_URL and RATE_PROVIDERS."""
+    providers = [RateProvider("open_er_api", EXCHANGE_RATES_API_URL, parse_open_er_api)]
+    for index, entry in enumerate(e.strip() for e in spec.split(",") if e.strip()):
+        kind, _, url = entry.partition("=")
+        parser = PROVIDER_PARSERS.get(kind.strip())
+        if parser is None or not url:
+            logger.error("Ignoring unknown rate provider: %s", entry)
+            continue
+        providers.append(RateProvider(f"{kind.strip()}_{index + 1}", url.strip(), parser))
+    return ProviderPool(providers)
+
+rate_providers = build_rate_providers()
+metrics.gauge("currenzbot_upstream_provider_healthy", "Whether each rate provider is healthy",
+              lambda: {n: int(s["healthy"]) for n, s in rate_providers.status().items()},
+              label="provider")
 
 def get_currency_emoji(currency_code):
     """Get the emoji flag for a currency code."""
@@ -64,27 +1207,296 @@ def get_currency_emoji(currency_code):
         return "".join([chr(ord(c.upper()) + 127397) for c in country_code])
     return EMOJI['money']  # Default to a money emoji if no flag found
 
-def get_exchange_rates(base_currency="USD"):
-    """Get the latest exchange rates for the given base currency.
-    This function uses the Open Exchange Rates API.
+class RateCache:
+    """In-memory cache of exchange rates keyed by base currency.
+
+    Rates are also written to the state backend, so with a shared backend
+    other workers start warm instead of refetching. The copy kept here
+    saves a backend read per lookup and outlives the TTL for get_stale.
     """
-    try:
-        logger.info(f"Requesting URL: {EXCHANGE_RATES_API_URL}{base_currency}")
-        response = requests.get(f"{EXCHANGE_RATES_API_URL}{base_currency}")
+
+    def __init__(self, ttl=RATES_CACHE_TTL, backend=None):
+        """Initialize an empty cache (on a private in-process backend by default)."""
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, base_currency):
+        """Fresh rates from this process or the backend, and where they were found."""
+        with self._lock:
+            entry = self._entries.get(base_currency)
+            if entry and entry[0] > time.monotonic():
+                return entry[1], "hit"
+        shared = self.backend.get("rates", base_currency)
+        if shared:
+            remaining = shared["expires"] - time.time()
+            with self._lock:
+                self._entries[base_currency] = (time.monotonic() + remaining, shared["rates"])
+            return shared["rates"], "shared_hit"
+        return None, "miss"
+
+    def get(self, base_currency):
+        """Get cached rates for a base currency, or None if missing or expired."""
+        rates, outcome = self._lookup(base_currency)
+        RATE_CACHE_LOOKUPS.inc(outcome)
+        return rates
+
+    def peek(self, base_currency):
+        """Like get(), but without counting a lookup."""
+        return self._lookup(base_currency)[0]
+
+    def set(self, base_currency, rates, ttl=None):
+        """Store rates for a base currency, for `ttl` seconds (default: the cache TTL)."""
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[base_currency] = (time.monotonic() + ttl, rates)
+        if ttl > 0:
+            self.backend.set("rates", base_currency,
+                             {"rates": rates, "expires": time.time() + ttl}, ttl=ttl)
+
+    def time_left(self, base_currency):
+        """Seconds until this process's cached rates for a base expire (0 if none)."""
+        entry = self._entries.get(base_currency)
+        return max(0.0, entry[0] - time.monotonic()) if entry else 0.0
+
+    def get_stale(self, base_currency):
+        """Rates for a base currency even if expired (until evicted), or None."""
+        entry = self._entries.get(base_currency)
+        return entry[1] if entry else None
+
+    def contains(self, base_currency):
+        """Check for fresh rates, here or in the backend, without counting a lookup."""
+        return self.peek(base_currency) is not None
+
+    def evict_expired(self):
+        """Drop entries whose TTL has passed."""
+        now = time.monotonic()
+        with self._lock:
+            for base_currency in [b for b, e in self._entries.items() if e[0] <= now]:
+                del self._entries[base_currency]
+
+    def __len__(self):
+        return len(self._entries)
+
+rate_cache = RateCache(backend=storage)
+
+class UpstreamQuota:
+    """Counts upstream calls per quota window and projects when the budget runs out.
+
+    The count is kept in a state backend that outlives the process and is
+    shared with the other processes on the host, so they all add to the same
+    count. Windows are fixed and start when the first call of a window is
+    made. status() is asked on every cache miss, so its report is reused for
+    `status_interval` seconds instead of re-reading the count each time.
+    """
+
+    def __init__(self, backend, limit=UPSTREAM_QUOTA, window=UPSTREAM_QUOTA_WINDOW,
+                 status_interval=QUOTA_STATUS_INTERVAL):
+        self.limit = limit
+        self.window = window
+        self.backend = backend
+        self.status_interval = status_interval
+        self._lock = threading.Lock()
+        self._report = None
+        self._report_at = 0.0
+
+    def _new_window(self, now):
+        return {"window_start": now, "used": 0, "by_provider": {}}
+
+    def _current(self, state, now):
+        """The state for the window containing `now`, starting a new one if needed."""
+        if state is None or now >= state["window_start"] + self.window:
+            return self._new_window(now)
+        return state
+
+    def _load(self):
+        """Read the persisted count."""
+        return self.backend.get("quota", "upstream")
+
+    def record(self, provider):
+        """Count one call to `provider`."""
+        def apply(state):
+            state = self._current(state, time.time())
+            state["used"] += 1
+            state["by_provider"][provider] = state["by_provider"].get(provider, 0) + 1
+            return state
         
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('result') == 'success':
-                return data.get('rates', {})
-            else:
-                logger.error(f"API error: {data.get('error')}")
-                return None
+        try:
+            self.backend.update("quota", "upstream", apply)
+        except Exception as e:
+            logger.error("Error recording upstream quota: %s", e)
+
+    def status(self):
+        """Budget state: usage, burn rate, projection and the resulting policy.
+
+        The report may be up to `status_interval` seconds old.
+        """
+        with self._lock:
+            if self._report is not None and time.monotonic() - self._report_at < self.status_interval:
+                return self._report
+        # Re-read the count to pick up calls made by other processes
+        report = self._build_report(self._load(), time.time())
+        with self._lock:
+            self._report, self._report_at = report, time.monotonic()
+        return report
+
+    def last_status(self):
+        """The most recent report without refreshing it, so callers can read one snapshot."""
+        with self._lock:
+            report = self._report
+        return report if report is not None else self.status()
+
+    def _build_report(self, state, now):
+        """The budget report for one snapshot of the stored count."""
+        state = self._current(state, now)
+        used = state["used"]
+        elapsed = now - state["window_start"]
+        remaining_time = max(1.0, state["window_start"] + self.window - now)
+        # Early in a window a handful of calls would project wildly
+        burn_rate = used / max(elapsed, 3600.0)
+        report = {
+            "limit": self.limit or None,
+            "used": used,
+            "by_provider": dict(state["by_provider"]),
+            "window_start": datetime.datetime.fromtimestamp(state["window_start"]).strftime("%Y-%m-%d %H:%M"),
+            "window_end": datetime.datetime.fromtimestamp(now + remaining_time).strftime("%Y-%m-%d %H:%M"),
+            "calls_per_hour": round(burn_rate * 3600, 2),
+            "projected_use": round(used + burn_rate * remaining_time),
+            "remaining": None,
+            "exhausts_at": None,
+            "ttl_stretch": 1.0,
+            "mode": "unlimited",
+        }
+        if self.limit <= 0:
+            return report
+        remaining = max(0, self.limit - used)
+        report["remaining"] = remaining
+        if burn_rate > 0 and remaining / burn_rate < remaining_time:
+            report["exhausts_at"] = datetime.datetime.fromtimestamp(
+                now + remaining / burn_rate).strftime("%Y-%m-%d %H:%M")
+        # Stretch the TTL by how much faster we burn than the budget allows
+        sustainable = remaining / remaining_time
+        stretch = QUOTA_MAX_TTL_STRETCH if sustainable <= 0 else burn_rate / sustainable
+        report["ttl_stretch"] = round(min(QUOTA_MAX_TTL_STRETCH, max(1.0, stretch)), 2)
+        if remaining == 0:
+            report["mode"] = "exhausted"
+        elif used >= QUOTA_DERIVE_AT * self.limit:
+            report["mode"] = "derive"
+        elif report["ttl_stretch"] > 1.0:
+            report["mode"] = "stretch"
         else:
-            logger.error(f"HTTP error: {response.status_code}")
-            return None
-    except Exception as e:
-        logger.error(f"Error getting exchange rates: {e}")
-        return None
+            report["mode"] = "normal"
+        return report
+
+upstream_quota = UpstreamQuota(storage if storage.shared else SQLiteBackend(UPSTREAM_QUOTA_FILE))
+
+# Gauges render in registration order, so "remaining" reuses the report "used" read
+metrics.gauge("currenzbot_upstream_quota_used", "Upstream calls made in the current quota window",
+              lambda: upstream_quota.status()["used"])
+metrics.gauge("currenzbot_upstream_quota_remaining", "Upstream calls left in the current quota window",
+              lambda: upstream_quota.last_status()["remaining"])
+
+def derive_rates(base_currency, anchors, stale=False):
+    """Cross rates for `base_currency` from cached rates of an anchor currency.
+
+    With rates r relative to anchor A, 1 base = r[x] / r[base] units of x.
+    Only fresh anchor rates are used unless `stale` is set, for when the
+    alternative is no answer. Returns (rates, anchor) or (None, None).
+    """
+    for anchor in anchors:
+        # peek() so that probing anchors does not count as cache lookups
+        anchor_rates = rate_cache.get_stale(anchor) if stale else rate_cache.peek(anchor)
+        if anchor_rates and anchor_rates.get(base_currency):
+            scale = anchor_rates[base_currency]
+            return {code: rate / scale for code, rate in anchor_rates.items()}, anchor
+    return None, None
+memory_monitor.register_structure("rate_cache_entries", lambda: len(rate_cache))
+memory_monitor.register_pressure_hook(rate_cache.evict_expired)
+
+def get_exchange_rates(base_currency="USD"):
+    """Get the latest exchange rates for the given base currency.
+    Rates are served from the cache or fetched from the configured providers.
+    """
+    rates = rate_cache.get(base_currency)
+    trace = current_trace()
+    if trace is not None:
+        trace.note_cache_lookup(rates is not None)
+    if rates is not None:
+        return rates
+
+    budget = upstream_quota.status()
+    ttl = RATES_CACHE_TTL * budget["ttl_stretch"]
+    if budget["mode"] == "exhausted":
+        # No calls left: answer from whatever is cached, however old
+        rates = rate_cache.get_stale(base_currency)
+        if rates is None:
+            rates, _ = derive_rates(base_currency, [a for a in RATE_ANCHORS if a != base_currency],
+                                    stale=True)
+        if rates is None:
+            logger.warning("Upstream quota exhausted and no cached rates for %s", base_currency)
+        return rates
+    if budget["mode"] == "derive" and base_currency not in RATE_ANCHORS:
+        rates, anchor = derive_rates(base_currency, RATE_ANCHORS)
+        if rates is None and RATE_ANCHORS:
+            # Spend the call on refreshing an anchor so later bases can be derived too
+            get_exchange_rates(RATE_ANCHORS[0])
+            rates, anchor = derive_rates(base_currency, RATE_ANCHORS)
+        if rates is not None:
+            RATE_CACHE_LOOKUPS.inc("derived")
+            # Derived rates must not outlive the anchor rates they came from
+            rate_cache.set(base_currency, rates, ttl=min(ttl, rate_cache.time_left(anchor)))
+            return rates
+
+    with trace_span("upstream"):
+        rates = fetch_exchange_rates(base_currency)
+    if rates:
+        rate_cache.set(base_currency, rates, ttl=ttl)
+        health.note_upstream_success()
+    return rates
+
+def fetch_exchange_rates(base_currency="USD"):
+    """Request exchange rates from the providers, bypassing the cache.
+
+    The best-ranked provider is asked first. If it has not answered within
+    its p95 latency, the next provider is asked as well (a hedged request),
+    and a failed provider is replaced by the next one straight away. The
+    first successful answer wins.
+    """
+    providers = rate_providers.ranked()
+    deadline = time.monotonic() + UPSTREAM_TIMEOUT
+    pending = {}
+    next_index = 0
+
+    def launch():
+        nonlocal next_index
+        provider = providers[next_index]
+        next_index += 1
+        pending[upstream_executor.submit(provider.fetch, base_currency)] = provider
+        return provider
+
+    current = launch()
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        timeout = min(current.hedge_delay(), remaining) if next_index < len(providers) else remaining
+        done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            current = launch()
+            UPSTREAM_HEDGES.inc("hedge")
+            continue
+        for future in done:
+            del pending[future]
+            rates = future.result()
+            if rates:
+                return rates
+        if next_index < len(providers):
+            current = launch()
+            UPSTREAM_HEDGES.inc("failover")
+
+    logger.error("No rate provider answered for %s", base_currency)
+    return None
 
 def convert_currency(amount, from_currency, to_currency):
     """Convert an amount from one currency to another."""
@@ -100,10 +1512,10 @@ def convert_currency(amount, from_currency, to_currency):
             # Calculate the conversion
             return amount * rates[to_currency]
         else:
-            logger.error(f"Currency not found: {to_currency}")
+            logger.error("Currency not found: %s", to_currency)
             return None
     except Exception as e:
-        logger.error(f"Error converting currency: {e}")
+        logger.error("Error converting currency: %s", e)
         return None
 
 def format_currency(amount, currency_code):
@@ -130,92 +1542,586 @@ def get_currency_comparison(base_currency, target_currencies=None):
             
             return comparison
         else:
-            logger.error(f"Could not get rates for {base_currency}")
+            logger.error("Could not get rates for %s", base_currency)
+            return None
+    except Exception as e:
+        logger.error("Error comparing currencies: %s", e)
+        return None
+
+# Names of well-known currencies; other codes reported by the API get a generic name
+CURRENCY_NAMES = {
+    "USD": "US Dollar",
+    "EUR": "Euro",
+    "GBP": "British Pound",
+    "JPY": "Japanese Yen",
+    "AUD": "Australian Dollar",
+    "CAD": "Canadian Dollar",
+    "CHF": "Swiss Franc",
+    "CNY": "Chinese Yuan",
+    "HKD": "Hong Kong Dollar",
+    "NZD": "New Zealand Dollar",
+    "SEK": "Swedish Krona",
+    "KRW": "South Korean Won",
+    "SGD": "Singapore Dollar",
+    "NOK": "Norwegian Krone",
+    "MXN": "Mexican Peso",
+    "INR": "Indian Rupee",
+    "RUB": "Russian Ruble",
+    "ZAR": "South African Rand",
+    "TRY": "Turkish Lira",
+    "BRL": "Brazilian Real",
+    "TWD": "Taiwan Dollar",
+    "DKK": "Danish Krone",
+    "PLN": "Polish Zloty",
+    "THB": "Thai Baht",
+    "IDR": "Indonesian Rupiah",
+    "HUF": "Hungarian Forint",
+    "CZK": "Czech Koruna",
+    "ILS": "Israeli Shekel",
+    "CLP": "Chilean Peso",
+    "PHP": "Philippine Peso",
+    "AED": "UAE Dirham",
+    "COP": "Colombian Peso",
+    "SAR": "Saudi Riyal",
+    "MYR": "Malaysian Ringgit",
+    "RON": "Romanian Leu",
+    "BTC": "Bitcoin"
+}
+
+class CurrencyIndex:
+    """Search index over currency codes and names.
+
+    A prefix table answers short queries ("us", "swiss") and a trigram table
+    tolerates typos and partial words ("yuan", "rupe"), so the /convert
+    picker can narrow ~160 currencies to a handful from one typed message.
+    """
+
+    def __init__(self, names=None):
+        self.names = {}
+        self._prefixes = defaultdict(set)
+        self._trigrams = defaultdict(set)
+        self._lock = threading.Lock()
+        for code, name in (names or {}).items():
+            self.add(code, name)
+
+    @staticmethod
+    def _grams(text):
+        """Trigrams of a lowercased, space-padded string."""
+        padded = f" {text.lower()} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _terms(self, code, name):
+        """Prefixes and trigrams under which a currency is indexed."""
+        prefixes = {word[:i] for word in [code.lower()] + name.lower().split()
+                    for i in range(1, min(len(word), 10) + 1)}
+        return prefixes, self._grams(code) | self._grams(name)
+
+    def add(self, code, name=None):
+        """Index a currency, or re-index it under a new name; returns True if the code was new."""
+        name = name or f"{code} Currency"
+        with self._lock:
+            old_name = self.names.get(code)
+            if old_name == name:
+                return False
+            if old_name is not None:
+                self._discard(code, old_name)
+            self.names[code] = name
+            prefixes, grams = self._terms(code, name)
+            for prefix in prefixes:
+                self._prefixes[prefix].add(code)
+            for gram in grams:
+                self._trigrams[gram].add(code)
+        return old_name is None
+
+    def _discard(self, code, name):
+        """Remove a currency from the terms of `name` (lock held)."""
+        prefixes, grams = self._terms(code, name)
+        for table, terms in ((self._prefixes, prefixes), (self._trigrams, grams)):
+            for term in terms:
+                codes = table.get(term)
+                if codes is not None:
+                    codes.discard(code)
+                    if not codes:
+                        del table[term]
+
+    def codes(self):
+        """All indexed codes, sorted."""
+        with self._lock:
+            return sorted(self.names)
+
+    def search(self, query, limit=12):
+        """Codes matching a typed query, best matches first."""
+        query = query.strip().lower()
+        if not query:
+            return []
+        code = query.upper()
+        words = query.split()
+        grams = self._grams(query) if len(query) >= 3 else set()
+        # Copy the candidate sets so a concurrent add() cannot change them mid-search
+        with self._lock:
+            known = code in self.names
+            matches = set.intersection(*(set(self._prefixes.get(w, ())) for w in words))
+            candidates = [tuple(self._trigrams.get(gram, ())) for gram in grams]
+        results = [code] if known else []
+        results += sorted(matches - set(results), key=lambda c: (c not in POPULAR_CURRENCIES, c))
+        if len(results) < limit and grams:
+            scores = Counter()
+            for codes in candidates:
+                scores.update(codes)
+            seen = set(results)
+            results += [c for c, score in scores.most_common()
+                        if c not in seen and score / len(grams) >= 0.5]
+        return results[:limit]
+
+currency_index = CurrencyIndex(CURRENCY_NAMES)
+memory_monitor.register_structure("currency_index_terms",
+                                  lambda: len(currency_index._prefixes) + len(currency_index._trigrams))
+
+def get_supported_currencies():
+    """Get a list of supported currencies with their emojis."""
+    try:
+        # Get the exchange rates for USD to see all supported currencies
+        rates = get_exchange_rates("USD")
+        
+        if rates:
+            currencies = dict(CURRENCY_NAMES)
+            
+            # For any currencies in the rates that are not in our hardcoded list,
+            # add them with a generic name
+            for currency in rates.keys():
+                if currency not in currencies:
+                    currencies[currency] = f"{currency} Currency"
+            
+            return currencies
+        else:
+            logger.error("Could not get supported currencies")
             return None
     except Exception as e:
-        logger.error(f"Error comparing currencies: {e}")
+        logger.error("Error getting supported currencies: %s", e)
         return None
 
-def get_supported_currencies():
-    """Get a list of supported currencies with their emojis."""
-    try:
-        # Get the exchange rates for USD to see all supported currencies
-        rates = get_exchange_rates("USD")
-        
-        if rates:
-            # Create a dictionary of currency codes and their names (hardcoded for now)
-            currencies = {
-                "USD": "US Dollar",
-                "EUR": "Euro",
-                "GBP": "British Pound",
-                "JPY": "Japanese Yen",
-                "AUD": "Australian Dollar",
-                "CAD": "Canadian Dollar",
-                "CHF": "Swiss Franc",
-                "CNY": "Chinese Yuan",
-                "HKD": "Hong Kong Dollar",
-                "NZD": "New Zealand Dollar",
-                "SEK": "Swedish Krona",
-                "KRW": "South Korean Won",
-                "SGD": "Singapore Dollar",
-                "NOK": "Norwegian Krone",
-                "MXN": "Mexican Peso",
-                "INR": "Indian Rupee",
-                "RUB": "Russian Ruble",
-                "ZAR": "South African Rand",
-                "TRY": "Turkish Lira",
-                "BRL": "Brazilian Real",
-                "TWD": "Taiwan Dollar",
-                "DKK": "Danish Krone",
-                "PLN": "Polish Zloty",
-                "THB": "Thai Baht",
-                "IDR": "Indonesian Rupiah",
-                "HUF": "Hungarian Forint",
-                "CZK": "Czech Koruna",
-                "ILS": "Israeli Shekel",
-                "CLP": "Chilean Peso",
-                "PHP": "Philippine Peso",
-                "AED": "UAE Dirham",
-                "COP": "Colombian Peso",
-                "SAR": "Saudi Riyal",
-                "MYR": "Malaysian Ringgit",
-                "RON": "Romanian Leu",
-                "BTC": "Bitcoin"
-            }
-            
-            # For any currencies in the rates that are not in our hardcoded list,
-            # add them with a generic name
-            for currency in rates.keys():
-                if currency not in currencies:
-                    currencies[currency] = f"{currency} Currency"
-            
-            return currencies
-        else:
-            logger.error("Could not get supported currencies")
-            return None
-    except Exception as e:
-        logger.error(f"Error getting supported currencies: {e}")
-        return None
+# --- ANALYTICS MODULE ---
+# Path to the analytics data file
+ANALYTICS_FILE = 'user_analytics.json'
+# With a shared state backend, how often reads pick up other processes' writes (seconds)
+ANALYTICS_REFRESH_INTERVAL = float(os.environ.get("ANALYTICS_REFRESH_INTERVAL", 5))
+
+# Append-only log of every tracked event, one JSON object per line. Unlike
+# the aggregated data file it keeps the full history and can be read
+# line by line, so exports never load it whole.
+ANALYTICS_EVENTS_FILE = 'user_analytics.events.ndjson'
+ANALYTICS_EXPORT_FIELDS = ("time", "type", "user_id", "command", "from", "to", "amount")
+# The log is rotated to .1, .2, ... once it grows past this size (bytes),
+# keeping ANALYTICS_EVENTS_BACKUPS old files
+ANALYTICS_EVENTS_MAX_BYTES = int(os.environ.get("ANALYTICS_EVENTS_MAX_BYTES", 64 * 1024 * 1024))
+ANALYTICS_EVENTS_BACKUPS = int(os.environ.get("ANALYTICS_EVENTS_BACKUPS", 5))
+# How often a process checks the log's size and whether another process rotated it (seconds)
+ANALYTICS_EVENTS_CHECK_INTERVAL = 1.0
+
+class AnalyticsEventLog:
+    """Append-only NDJSON event log shared by every process on the host.
+
+    Each event is written with a single os.write on an O_APPEND descriptor,
+    so lines from several processes never interleave. The file is created
+    by the first event, not when the log object is made, and rotated by
+    size; a process that finds the file rotated under it reopens it.
+    """
+
+    def __init__(self, path=ANALYTICS_EVENTS_FILE, max_bytes=ANALYTICS_EVENTS_MAX_BYTES,
+                 backups=ANALYTICS_EVENTS_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._fd = None
+        self._checked = 0.0
+        self._backfill = None
+        self._lock = threading.Lock()
+
+    def backfill(self, conversions):
+        """Seed a new log with the conversions already in the data file.
+
+        The events are written when the log file is first created, and only
+        by the process that creates it.
+        """
+        self._backfill = list(conversions)
+
+    def _backfill_lines(self):
+        for conv in self._backfill or ():
+            event = {"time": f"{conv['date']}T00:00:00", "type": "conversion",
+                     "from": conv["from"], "to": conv["to"], "amount": conv["amount"]}
+            if conv.get("user_id"):
+                event["user_id"] = conv["user_id"]
+            yield json.dumps(event) + "\n"
+
+    def _open(self):
+        """Open the log for appending, creating it (and its backfill) if needed (lock held)."""
+        try:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+            # A rotated log means the history is already there
+            if self._backfill and not os.path.exists(f"{self.path}.1"):
+                os.write(self._fd, "".join(self._backfill_lines()).encode())
+        except FileExistsError:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._backfill = None
+        self._checked = time.monotonic()
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _check(self):
+        """Reopen the log if another process rotated it, and rotate it if it is full (lock held)."""
+        self._checked = time.monotonic()
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            self._close()
+            return
+        opened = os.fstat(self._fd)
+        if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            self._close()
+        elif self.max_bytes > 0 and current.st_size >= self.max_bytes:
+            self._rotate()
+            self._close()
+
+    def _rotate(self):
+        """Shift path.1 .. path.N up by one and move the log to path.1."""
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+
+    def append(self, event_type, **fields):
+        """Write one event stamped with the current time."""
+        event = {"time": datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), "type": event_type}
+        event.update((k, v) for k, v in fields.items() if v is not None)
+        line = (json.dumps(event) + "\n").encode()
+        try:
+            with self._lock, trace_span("analytics"):
+                if self._fd is not None and time.monotonic() - self._checked > ANALYTICS_EVENTS_CHECK_INTERVAL:
+                    self._check()
+                if self._fd is None:
+                    self._open()
+                os.write(self._fd, line)
+        except Exception as e:
+            logger.error("Error writing analytics event: %s", e)
+
+    def iter_events(self, start=None, end=None):
+        """Yield events whose date (YYYY-MM-DD) is within [start, end], oldest first.
+
+        Rotated files are read before the current one, line by line; a
+        partially written last line is skipped.
+        """
+        paths = [f"{self.path}.{i}" for i in range(self.backups, 0, -1)] + [self.path]
+        for path in paths:
+            try:
+                f = open(path, 'r')
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    day = event.get("time", "")[:10]
+                    if (start and day < start) or (end and day > end):
+                        continue
+                    yield event
+
+# Users get dense integer ids and activity is kept as bitsets over those ids
+# (Python ints in memory, hex strings only when stored): one per day, one per
+# month and one per first-seen month cohort. Counting active users is a
+# popcount and retention is an AND of two bitsets.
+ACTIVITY_DAYS_KEPT = int(os.environ.get("ACTIVITY_DAYS_KEPT", 35))
+RETENTION_MONTHS = int(os.environ.get("RETENTION_MONTHS", 6))
+
+def _bitset(value):
+    """Decode a stored hex bitset."""
+    return int(value, 16) if value else 0
+
+def _bitset_str(bits):
+    """Encode a bitset for storage."""
+    return format(bits, "x")
+
+def _bitset_members(bits, index):
+    """User ids whose bits are set, visiting only the set bits.
+
+    Shifting a big int is O(n), so the bitset is scanned as bytes instead.
+    """
+    by_bit = {bit: user_id for user_id, bit in index.items()}
+    members = []
+    for offset, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, "little")):
+        while byte:
+            low = byte & -byte
+            members.append(by_bit.get(offset * 8 + low.bit_length() - 1))
+            byte ^= low
+    return members
+
+def _add_months(month, count):
+    """Shift a YYYY-MM month key by `count` months."""
+    year, mon = map(int, month.split("-"))
+    year, mon = divmod(year * 12 + mon - 1 + count, 12)
+    return f"{year:04d}-{mon + 1:02d}"
+
+def _ensure_activity(data):
+    """Return data["activity"], building the bitsets from user records if missing."""
+    if "user_index" in data:
+        return data["activity"]
+    cutoff = (datetime.date.today() - datetime.timedelta(days=ACTIVITY_DAYS_KEPT)).isoformat()
+    days, months, cohorts = defaultdict(int), defaultdict(int), defaultdict(int)
+    users = sorted(data["users"].items(), key=lambda item: item[1].get("first_seen", ""))
+    index = {}
+    for bit, (user_id, user) in enumerate(users):
+        index[user_id] = bit
+        mask = 1 << bit
+        for month in user.get("monthly_usage", {}):
+            months[month] |= mask
+        for day in {user.get("first_seen"), user.get("last_seen")}:
+            if day and day >= cutoff:
+                days[day] |= mask
+        if user.get("first_seen"):
+            cohorts[user["first_seen"][:7]] |= mask
+    data["user_index"] = index
+    data["activity"] = {"days": dict(days), "months": dict(months), "cohorts": dict(cohorts)}
+    return data["activity"]
+
+def _decode_activity(data):
+    """Turn stored hex bitsets into ints in place."""
+    for table in data["activity"].values():
+        for key, bits in table.items():
+            if isinstance(bits, str):
+                table[key] = _bitset(bits)
+
+def _encode_activity(data):
+    """A shallow copy of analytics data with its bitsets hex-encoded for storage."""
+    activity = {period: {key: _bitset_str(bits) for key, bits in table.items()}
+                for period, table in data["activity"].items()}
+    return dict(data, activity=activity)
+
+def _mark_active(data, user_id, day, is_new):
+    """Set the user's bit in the day and month bitsets (and cohort if new)."""
+    activity = _ensure_activity(data)
+    index = data["user_index"]
+    bit = index.get(user_id)
+    if bit is None:
+        # Row storage only loads the rows an update needs, so it keeps the counter
+        bit = index[user_id] = data.get("next_index", len(index))
+        if "next_index" in data:
+            data["next_index"] = bit + 1
+    mask = 1 << bit
+    days = activity["days"]
+    if day not in days:
+        cutoff = (datetime.date.fromisoformat(day) - datetime.timedelta(days=ACTIVITY_DAYS_KEPT)).isoformat()
+        for old in [d for d in days if d < cutoff]:
+            del days[old]
+    periods = [("days", day), ("months", day[:7])]
+    if is_new:
+        periods.append(("cohorts", day[:7]))
+    for period, key in periods:
+        table = activity[period]
+        table[key] = table.get(key, 0) | mask
+
+# With a state backend, analytics are stored as one row per user, command,
+# conversion, summary month and activity bitset, so an event only rewrites
+# the rows it touches and readers only fetch rows changed since their last read.
+def _new_row_id():
+    """A unique, roughly time-ordered id for a conversion row."""
+    return f"{time.time_ns():x}-{os.getpid():x}-{random.getrandbits(16):x}"
+
+def _analytics_rows(data):
+    """Split analytics data into {row key: value}; bitsets stay ints."""
+    rows = {}
+    for user_id, user in data["users"].items():
+        rows[f"user:{user_id}"] = {"user": user, "index": data["user_index"].get(user_id)}
+    for command, record in data["commands"].items():
+        rows[f"command:{command}"] = record
+    for conv in data["conversions"]:
+        rows[f"conversion:{conv.setdefault('id', _new_row_id())}"] = conv
+    for month, counts in data.get("conversion_summary", {}).items():
+        rows[f"summary:{month}"] = counts
+    for period, table in data["activity"].items():
+        for key, bits in table.items():
+            rows[f"activity:{period}:{key}"] = bits
+    if "next_index" in data:
+        rows["meta:next_index"] = data["next_index"]
+    return rows
+
+def _encode_row(key, value):
+    """The stored form of a row: bitsets become hex strings."""
+    if value is not None and key.startswith("activity:"):
+        return _bitset_str(value)
+    return value
+
+def _decode_row(key, value):
+    """A row as read from storage, with bitsets turned back into ints."""
+    if isinstance(value, str) and key.startswith("activity:"):
+        return _bitset(value)
+    return value
+
+def _row_snapshot(value):
+    """A comparable copy of a row; ints (bitsets) are immutable and compare as-is."""
+    return value if isinstance(value, int) else json.dumps(value, sort_keys=True)
+
+def _apply_analytics_row(data, key, value):
+    """Apply one decoded row to analytics data; a value of None removes it."""
+    kind, _, name = key.partition(":")
+    if kind == "user":
+        if value is None:
+            for table in ("users", "user_index", "first_seen"):
+                data[table].pop(name, None)
+            return
+        data["users"][name] = value["user"]
+        data["first_seen"][name] = value["user"].get("first_seen")
+        if value.get("index") is not None:
+            data["user_index"][name] = value["index"]
+    elif kind == "command":
+        _set_or_pop(data["commands"], name, value)
+    elif kind == "summary":
+        _set_or_pop(data["conversion_summary"], name, value)
+    elif kind == "activity":
+        period, _, period_key = name.partition(":")
+        _set_or_pop(data["activity"].setdefault(period, {}), period_key, value)
+    elif kind == "meta" and name == "next_index":
+        data["next_index"] = value or 0
+    elif kind == "conversion" and value is not None:
+        data["conversions"].append(value)
 
-# --- ANALYTICS MODULE ---
-# Path to the analytics data file
-ANALYTICS_FILE = 'user_analytics.json'
+def _set_or_pop(table, key, value):
+    if value is None:
+        table.pop(key, None)
+    else:
+        table[key] = value
 
 class BotAnalytics:
     """Class to handle bot usage analytics."""
     
-    def __init__(self):
-        """Initialize the analytics system."""
-        self.data = self._load_data()
+    def __init__(self, lazy=False, backend=None, name=None):
+        """Initialize the analytics system.
+
+        With `lazy` the data is read on first use (or by preload_async)
+        instead of immediately. The data lives in the state `backend` as rows
+        and every change atomically rewrites only the rows it touches, so
+        several processes can track usage without overwriting each other.
+        A backend that is not shared does not outlive the process, so the
+        data is also saved to the JSON file, which is read back on startup.
+        A `name` keeps a bot's data apart from the others in multi-tenant mode.
+        """
+        self.name = name
+        suffix = f".{name}" if name else ""
+        self.path = ANALYTICS_FILE.replace(".json", f"{suffix}.json")
+        self.backend_key = f"data:{name}" if name else "data"
+        self.namespace = f"analytics_rows:{name}" if name else "analytics_rows"
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._data = None
+        self._refreshed = 0.0
+        # Backend version of the rows merged into _data, and its conversions by key
+        self._version = 0
+        self._conversion_rows = {}
+        self._load_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # Writes in progress or waiting for the write lock (the flush backlog)
+        self.pending_writes = 0
+        self._pending_lock = threading.Lock()
+        self.events = AnalyticsEventLog(ANALYTICS_EVENTS_FILE.replace(".events", f"{suffix}.events"))
+        if not lazy:
+            self._ensure_loaded()
+    
+    @property
+    def data(self):
+        """The analytics data, loaded on first access."""
+        if self._data is None:
+            self._ensure_loaded()
+        elif self.backend.shared and time.monotonic() - self._refreshed > ANALYTICS_REFRESH_INTERVAL:
+            self._refresh()
+        return self._data
+    
+    @data.setter
+    def data(self, value):
+        self._data = value
+    
+    def _ensure_loaded(self):
+        """Load the data file exactly once."""
+        with self._load_lock:
+            if self._data is None:
+                started = time.perf_counter()
+                self._data = self._load_data()
+                self._refreshed = time.monotonic()
+                self.events.backfill(self._data["conversions"])
+                record_startup_phase("analytics_load", started)
+    
+    def preload_async(self):
+        """Load the data file in a background thread."""
+        thread = threading.Thread(target=self._ensure_loaded, name="analytics-preload")
+        thread.daemon = True
+        thread.start()
         
     def _load_data(self):
-        """Load analytics data from the JSON file."""
-        if os.path.exists(ANALYTICS_FILE):
+        """Load analytics data from the backend rows."""
+        data = self._read_rows()
+        # Data saved before activity bitsets existed gets them built here
+        _ensure_activity(data)
+        return data
+    
+    def _read_rows(self):
+        """Build the data from the backend rows, importing older data on first use."""
+        rows, version = self.backend.changes(self.namespace)
+        if not rows:
+            self._import_rows()
+            rows, version = self.backend.changes(self.namespace)
+        data = self._get_empty_data()
+        data["next_index"] = 0
+        self._conversion_rows = {}
+        self._version = 0
+        self._merge_rows(data, ((key, _decode_row(key, value)) for key, value in rows), version)
+        return data
+    
+    def _import_rows(self):
+        """Write the existing blob or file as rows, unless another process already did."""
+        data = self.backend.get("analytics", self.backend_key) or self._read_file()
+        _ensure_activity(data)
+        _decode_activity(data)
+        data["next_index"] = max(data["user_index"].values(), default=-1) + 1
+        rows = {key: _encode_row(key, value) for key, value in _analytics_rows(data).items()}
+        # Only the first process to get here imports
+        self.backend.update_many(self.namespace, ["meta:next_index"],
+                                 lambda values: {} if values["meta:next_index"] is not None else rows)
+    
+    def _merge_rows(self, data, rows, version):
+        """Apply decoded rows from the backend to the in-memory data."""
+        conversions_changed = False
+        for key, value in rows:
+            if key.startswith("conversion:"):
+                _set_or_pop(self._conversion_rows, key, value)
+                conversions_changed = True
+            else:
+                _apply_analytics_row(data, key, value)
+        if conversions_changed:
+            data["conversions"] = list(self._conversion_rows.values())
+        self._version = max(self._version, version)
+    
+    def _refresh(self):
+        """Pick up the rows other processes changed since the last read."""
+        try:
+            rows, version = self.backend.changes(self.namespace, self._version)
+            with self._write_lock:
+                self._merge_rows(self._data, ((key, _decode_row(key, value)) for key, value in rows), version)
+        except Exception as e:
+            logger.error("Error refreshing analytics data: %s", e)
+        self._refreshed = time.monotonic()
+    
+    def _read_file(self):
+        """Read the analytics JSON file, or empty data."""
+        if os.path.exists(self.path):
             try:
-                with open(ANALYTICS_FILE, 'r') as f:
+                with open(self.path, 'r') as f:
                     return json.load(f)
             except (json.JSONDecodeError, FileNotFoundError) as e:
-                logger.error(f"Error loading analytics data: {e}")
+                logger.error("Error loading analytics data: %s", e)
                 return self._get_empty_data()
         else:
             return self._get_empty_data()
@@ -226,74 +2132,142 @@ class BotAnalytics:
             "users": {},
             "commands": {},
             "conversions": [],
-            "first_seen": {}
+            "conversion_summary": {},
+            "first_seen": {},
+            "user_index": {},
+            "activity": {"days": {}, "months": {}, "cohorts": {}}
         }
     
     def _save_data(self):
         """Save analytics data to the JSON file."""
         try:
-            with open(ANALYTICS_FILE, 'w') as f:
-                json.dump(self.data, f, indent=2)
+            # Write a temporary file and swap it in so readers never see a partial file
+            temp_file = f"{self.path}.tmp"
+            with open(temp_file, 'w') as f:
+                json.dump(_encode_activity(self._data), f, indent=2)
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            logger.error("Error saving analytics data: %s", e)
+    
+    def _apply(self, mutate, keys=()):
+        """Apply `mutate(data)` to the analytics data and persist the result.
+
+        With a backend, `mutate` runs on just the rows named in `keys` (plus
+        any rows it creates), read and written in one transaction.
+        """
+        with self._pending_lock:
+            self.pending_writes += 1
+        try:
+            self._apply_now(mutate, keys)
+        finally:
+            with self._pending_lock:
+                self.pending_writes -= 1
+    
+    def _apply_now(self, mutate, keys):
+        """Apply and persist a change; callers wait here while others write."""
+        # The changed rows as ints, so they are merged without decoding them again
+        changed = {}
+        
+        def update(values):
+            part = self._get_empty_data()
+            for key, value in values.items():
+                _apply_analytics_row(part, key, _decode_row(key, value))
+            before = {k: _row_snapshot(v) for k, v in _analytics_rows(part).items()}
+            mutate(part)
+            after = _analytics_rows(part)
+            changed.clear()
+            changed.update((k, v) for k, v in after.items() if _row_snapshot(v) != before.get(k))
+            changed.update((k, None) for k in before if k not in after)
+            # Only the bitsets that changed are hex-encoded
+            return {k: _encode_row(k, v) for k, v in changed.items()}
+        
+        # The rows must be loaded before writes are merged into them
+        self._ensure_loaded()
+        try:
+            with ANALYTICS_FLUSH_LATENCY.time(), trace_span("analytics"):
+                self.backend.update_many(self.namespace, list(keys), update)
+                with self._write_lock:
+                    self._merge_rows(self._data, changed.items(), 0)
+                    if not self.backend.shared:
+                        self._save_data()
         except Exception as e:
-            logger.error(f"Error saving analytics data: {e}")
+            logger.error("Error saving analytics data: %s", e)
     
     def track_user(self, user_id, username=None, first_name=None):
         """Track a user interaction."""
         user_id = str(user_id)  # Convert to string for JSON compatibility
         today = datetime.datetime.now().strftime('%Y-%m-%d')
         
-        if user_id not in self.data["users"]:
-            self.data["users"][user_id] = {
-                "interactions": 0,
-                "first_seen": today,
-                "last_seen": today,
-                "username": username,
-                "first_name": first_name,
-                "monthly_usage": {}
-            }
-            self.data["first_seen"][user_id] = today
+        def apply(data):
+            is_new = user_id not in data["users"]
+            # Bitsets only change on a user's first interaction of the day
+            if is_new or data["users"][user_id]["last_seen"] != today:
+                _mark_active(data, user_id, today, is_new)
+            if is_new:
+                data["users"][user_id] = {
+                    "interactions": 0,
+                    "first_seen": today,
+                    "last_seen": today,
+                    "username": username,
+                    "first_name": first_name,
+                    "monthly_usage": {}
+                }
+                data["first_seen"][user_id] = today
         
-        # Update user data
-        self.data["users"][user_id]["interactions"] += 1
-        self.data["users"][user_id]["last_seen"] = today
+            # Update user data
+            data["users"][user_id]["interactions"] += 1
+            data["users"][user_id]["last_seen"] = today
         
-        # Update username and first_name if provided
-        if username:
-            self.data["users"][user_id]["username"] = username
-        if first_name:
-            self.data["users"][user_id]["first_name"] = first_name
+            # Update username and first_name if provided
+            if username:
+                data["users"][user_id]["username"] = username
+            if first_name:
+                data["users"][user_id]["first_name"] = first_name
         
-        # Update monthly usage
-        month_key = datetime.datetime.now().strftime('%Y-%m')
-        if month_key not in self.data["users"][user_id]["monthly_usage"]:
-            self.data["users"][user_id]["monthly_usage"][month_key] = 0
-        self.data["users"][user_id]["monthly_usage"][month_key] += 1
+            # Update monthly usage
+            month_key = datetime.datetime.now().strftime('%Y-%m')
+            if month_key not in data["users"][user_id]["monthly_usage"]:
+                data["users"][user_id]["monthly_usage"][month_key] = 0
+            data["users"][user_id]["monthly_usage"][month_key] += 1
         
-        self._save_data()
+        keys = [f"user:{user_id}"]
+        user = self.data["users"].get(user_id)
+        # Only a first interaction of the day needs the bitset rows
+        if user is None or user["last_seen"] != today:
+            month = today[:7]
+            keys += ["meta:next_index", f"activity:days:{today}",
+                     f"activity:months:{month}", f"activity:cohorts:{month}"]
+            # Day bitsets past the retention window are dropped on a new day
+            cutoff = (datetime.date.today() - datetime.timedelta(days=ACTIVITY_DAYS_KEPT)).isoformat()
+            keys.extend(f"activity:days:{day}" for day in self.data["activity"]["days"] if day < cutoff)
+        self._apply(apply, keys)
+        self.events.append("user", user_id=user_id)
         
     def track_command(self, command, user_id=None):
         """Track a command usage."""
         today = datetime.datetime.now().strftime('%Y-%m-%d')
+        user_id = str(user_id) if user_id else None
         
-        if command not in self.data["commands"]:
-            self.data["commands"][command] = {
-                "count": 0,
-                "users": [],
-                "by_date": {}
-            }
+        def apply(data):
+            if command not in data["commands"]:
+                data["commands"][command] = {
+                    "count": 0,
+                    "users": [],
+                    "by_date": {}
+                }
         
-        self.data["commands"][command]["count"] += 1
+            data["commands"][command]["count"] += 1
         
-        if user_id:
-            user_id = str(user_id)
-            if user_id not in self.data["commands"][command]["users"]:
-                self.data["commands"][command]["users"].append(user_id)
+            if user_id:
+                if user_id not in data["commands"][command]["users"]:
+                    data["commands"][command]["users"].append(user_id)
         
-        if today not in self.data["commands"][command]["by_date"]:
-            self.data["commands"][command]["by_date"][today] = 0
-        self.data["commands"][command]["by_date"][today] += 1
+            if today not in data["commands"][command]["by_date"]:
+                data["commands"][command]["by_date"][today] = 0
+            data["commands"][command]["by_date"][today] += 1
         
-        self._save_data()
+        self._apply(apply, [f"command:{command}"])
+        self.events.append("command", command=command, user_id=user_id)
     
     def track_conversion(self, from_currency, to_currency, amount, user_id=None):
         """Track a currency conversion."""
@@ -309,37 +2283,72 @@ class BotAnalytics:
         if user_id:
             conversion["user_id"] = str(user_id)
         
-        self.data["conversions"].append(conversion)
-        self._save_data()
+        self._apply(lambda data: data["conversions"].append(conversion))
+        self.events.append("conversion", user_id=conversion.get("user_id"),
+                           **{"from": from_currency, "to": to_currency, "amount": amount})
     
     def get_monthly_users(self, month=None):
         """Get number of monthly active users."""
         if not month:
             month = datetime.datetime.now().strftime('%Y-%m')
         
-        monthly_users = set()
-        for user_id, user_data in self.data["users"].items():
-            if "monthly_usage" in user_data and month in user_data["monthly_usage"]:
-                monthly_users.add(user_id)
+        bits = _ensure_activity(self.data)["months"].get(month, 0)
         
         return {
-            "count": len(monthly_users),
-            "users": list(monthly_users)
+            "count": bits.bit_count(),
+            "users": _bitset_members(bits, self.data["user_index"])
+        }
+    
+    def get_active_users(self, days, end=None):
+        """Number of distinct users active in the `days` days up to `end` (default today)."""
+        end = end or datetime.date.today()
+        table = _ensure_activity(self.data)["days"]
+        bits = 0
+        for offset in range(days):
+            bits |= table.get((end - datetime.timedelta(days=offset)).isoformat(), 0)
+        return bits.bit_count()
+    
+    def get_engagement(self):
+        """Rolling daily, weekly and monthly active users and DAU/MAU stickiness."""
+        dau, wau, mau = (self.get_active_users(days) for days in (1, 7, 30))
+        return {
+            "dau": dau,
+            "wau": wau,
+            "mau": mau,
+            "stickiness": round(dau / mau * 100, 1) if mau else 0.0
         }
     
+    def get_cohort_retention(self, months=RETENTION_MONTHS):
+        """Share of each recent monthly cohort still active in the following months.
+
+        Returns one row per cohort (oldest first) with its size and the
+        percentage of the cohort active in months 0..n after it, up to the
+        current month.
+        """
+        activity = _ensure_activity(self.data)
+        current = datetime.datetime.now().strftime('%Y-%m')
+        rows = []
+        for back in range(months - 1, -1, -1):
+            cohort = _add_months(current, -back)
+            members = activity["cohorts"].get(cohort, 0)
+            size = members.bit_count()
+            retention = []
+            for offset in range(back + 1):
+                active = activity["months"].get(_add_months(cohort, offset), 0)
+                retention.append(round((members & active).bit_count() / size * 100, 1) if size else None)
+            rows.append({"cohort": cohort, "size": size, "retention": retention})
+        return rows
+    
     def get_new_users(self, month=None):
         """Get number of new users in the given month."""
         if not month:
             month = datetime.datetime.now().strftime('%Y-%m')
         
-        new_users = []
-        for user_id, first_seen in self.data["first_seen"].items():
-            if first_seen.startswith(month):
-                new_users.append(user_id)
+        bits = _ensure_activity(self.data)["cohorts"].get(month, 0)
         
         return {
-            "count": len(new_users),
-            "users": new_users
+            "count": bits.bit_count(),
+            "users": _bitset_members(bits, self.data["user_index"])
         }
     
     def get_top_commands(self, limit=5):
@@ -351,6 +2360,9 @@ class BotAnalytics:
         """Get the most popular currency conversions."""
         pairs = [(conv["from"], conv["to"]) for conv in self.data["conversions"]]
         counts = Counter(pairs)
+        for month_counts in self.data.get("conversion_summary", {}).values():
+            for pair, count in month_counts.items():
+                counts[tuple(pair.split(">", 1))] += count
         return counts.most_common(limit)
     
     def get_user_count(self):
@@ -362,11 +2374,13 @@ class BotAnalytics:
         if not month:
             month = datetime.datetime.now().strftime('%Y-%m')
         
-        active_users = self.get_monthly_users(month)
-        new_users = self.get_new_users(month)
+        # Only the counts are needed, so skip listing the users
+        activity = _ensure_activity(self.data)
+        active_users = activity["months"].get(month, 0).bit_count()
+        new_users = activity["cohorts"].get(month, 0).bit_count()
         
         # Count conversions in this month
-        conversions_count = 0
+        conversions_count = sum(self.data.get("conversion_summary", {}).get(month, {}).values())
         for conv in self.data["conversions"]:
             if conv["date"].startswith(month):
                 conversions_count += 1
@@ -380,160 +2394,1345 @@ class BotAnalytics:
         
         return {
             "month": month,
-            "active_users": active_users["count"],
-            "new_users": new_users["count"],
+            "active_users": active_users,
+            "new_users": new_users,
             "total_users": self.get_user_count(),
             "total_commands": commands_count,
             "total_conversions": conversions_count
         }
 
-# Initialize the analytics system
-analytics = BotAnalytics()
+    def compact(self):
+        """Fold conversions from previous months into per-month pair counts.
+
+        Individual conversion records are only needed for the current month;
+        older ones are kept as counts, which is all the reports use.
+        """
+        current_month = datetime.datetime.now().strftime('%Y-%m')
+        compacted = 0
+        
+        def apply(data):
+            nonlocal compacted
+            summary = data.setdefault("conversion_summary", {})
+            recent = []
+            for conv in data["conversions"]:
+                month = conv["date"][:7]
+                if month == current_month:
+                    recent.append(conv)
+                else:
+                    pair = f"{conv['from']}>{conv['to']}"
+                    month_counts = summary.setdefault(month, {})
+                    month_counts[pair] = month_counts.get(pair, 0) + 1
+            compacted = len(data["conversions"]) - len(recent)
+            data["conversions"] = recent
+        
+        old = [conv for conv in self.data["conversions"] if not conv["date"].startswith(current_month)]
+        if old:
+            keys = [f"conversion:{conv['id']}" for conv in old if "id" in conv]
+            keys.extend({f"summary:{conv['date'][:7]}" for conv in old})
+            self._apply(apply, keys)
+            logger.info("Compacted %d analytics conversion records", compacted)
+        return compacted
+
+# --- HEALTH MODULE ---
+# Liveness and readiness signals for /healthz and /readyz, and a watchdog
+# thread that restarts a bot whose polling loop has died or stopped making
+# progress.
+WATCHDOG_INTERVAL = float(os.environ.get("WATCHDOG_INTERVAL", 30))
+# Polling is stalled when getUpdates has not returned and no update arrived
+# for this many watchdog intervals
+WATCHDOG_STALL_INTERVALS = int(os.environ.get("WATCHDOG_STALL_INTERVALS", 3))
+# Consecutive failed restarts after which the watchdog gives up on a bot
+WATCHDOG_MAX_RESTARTS = int(os.environ.get("WATCHDOG_MAX_RESTARTS", 5))
+# The lag of the last update only counts for this long (seconds)
+UPDATE_LAG_WINDOW = float(os.environ.get("UPDATE_LAG_WINDOW", 300))
+# Readiness thresholds
+READY_MAX_UPDATE_LAG = float(os.environ.get("READY_MAX_UPDATE_LAG", 60))
+READY_MAX_RATES_AGE = float(os.environ.get("READY_MAX_RATES_AGE", 6 * 3600))
+READY_MAX_QUEUE_DEPTH = int(os.environ.get("READY_MAX_QUEUE_DEPTH", 500))
+READY_MAX_ANALYTICS_BACKLOG = int(os.environ.get("READY_MAX_ANALYTICS_BACKLOG", 50))
+
+class HealthMonitor:
+    """Collects health signals and watches the bots' polling loops."""
+
+    def __init__(self, interval=WATCHDOG_INTERVAL, stall_intervals=WATCHDOG_STALL_INTERVALS,
+                 max_restarts=WATCHDOG_MAX_RESTARTS):
+        self.interval = interval
+        self.stall_after = stall_intervals * interval
+        self.max_restarts = max_restarts
+        self.last_update = None
+        self.update_lag = None
+        self.last_upstream_success = None
+        self.polling_restarts = 0
+        self.updaters = {}
+        # Per bot: when getUpdates last returned and an update last arrived,
+        # restarts in a row without polling recovering, and when the last
+        # restart was made and the next may be made (monotonic)
+        self.last_poll = {}
+        self.last_bot_update = {}
+        self.restart_failures = {}
+        self.restarted_at = {}
+        self.next_restart = {}
+        self._beat = None
+        self._thread = None
+
+    def note_update(self, update, name=None):
+        """Record that an update reached the dispatcher of bot `name` and how late it was."""
+        self.last_update = time.time()
+        if name is not None:
+            self.last_bot_update[name] = time.monotonic()
+        message = update.message if update is not None else None
+        if message is not None and message.date is not None:
+            self.update_lag = max(0.0, self.last_update - message.date.timestamp())
+
+    def note_upstream_success(self):
+        """Record a successful fetch from a rate provider."""
+        self.last_upstream_success = time.time()
+
+    def watch(self, name, updater):
+        """Have the watchdog restart `updater` if its polling loop dies or hangs."""
+        self.updaters[name] = updater
+        self.last_poll[name] = time.monotonic()
+        self.restart_failures[name] = 0
+        self.restarted_at[name] = 0.0
+        self.next_restart[name] = 0.0
+        get_updates = updater.bot.get_updates
+
+        def tracked_get_updates(*args, **kwargs):
+            try:
+                return get_updates(*args, **kwargs)
+            finally:
+                self.last_poll[name] = time.monotonic()
+
+        # Long polling returns at least once per poll timeout, updates or not.
+        # object.__setattr__ skips PTB's warning about custom attributes.
+        object.__setattr__(updater.bot, "get_updates", tracked_get_updates)
+
+    def _stalled(self, name, updater):
+        """Whether the updater should be running but is not making progress.
+
+        That is one of its threads having died, or getUpdates not returning
+        and no update arriving for this bot for `stall_after` seconds. An
+        updater that was never started or was stopped on purpose is not stalled.
+        """
+        if not updater.running:
+            return False
+        # python-telegram-bot 13 keeps its polling and dispatcher threads in a private list
+        threads = getattr(updater, "_Updater__threads", [])
+        if not all(t.is_alive() for t in threads):
+            return True
+        # Only this bot's own updates count, so a busy bot cannot hide a hung one
+        now = time.monotonic()
+        last_seen = max(self.last_poll.get(name, now), self.last_bot_update.get(name, 0.0))
+        return now - last_seen > self.stall_after
+
+    def check(self):
+        """Restart every watched bot whose polling loop has stopped.
+
+        A bot that keeps stalling is retried with exponential backoff and
+        given up on after `max_restarts` restarts in a row that did not get
+        getUpdates going again (e.g. a revoked token, which no restart can fix).
+        """
+        now = time.monotonic()
+        self._beat = now
+        for name, updater in self.updaters.items():
+            if not self._stalled(name, updater):
+                if self.last_poll[name] > self.restarted_at[name]:
+                    # getUpdates has returned since the last restart, so it took
+                    self.restart_failures[name] = 0
+                continue
+            failures = self.restart_failures[name]
+            if failures >= self.max_restarts or now < self.next_restart[name]:
+                continue
+            logger.error("Polling for bot %s stalled, restarting it (attempt %d of %d)",
+                         name, failures + 1, self.max_restarts)
+            self.restart_failures[name] = failures + 1
+            self.next_restart[name] = now + self.interval * 2 ** failures
+            if self._restart(name, updater):
+                self.polling_restarts += 1
+            if self.restart_failures[name] >= self.max_restarts:
+                logger.error("Giving up restarting polling for bot %s", name)
+
+    def _restart(self, name, updater):
+        """Stop and restart an updater; False if that failed or timed out."""
+        def restart():
+            try:
+                updater.stop()
+                updater.start_polling()
+            except Exception as e:
+                logger.error("Error restarting polling for bot %s: %s", name, e)
+
+        # A hung getUpdates would block stop() forever, so don't wait on it
+        thread = threading.Thread(target=restart, name=f"restart-{name}", daemon=True)
+        thread.start()
+        thread.join(self.interval)
+        if thread.is_alive():
+            logger.error("Restarting polling for bot %s timed out", name)
+            return False
+        if not updater.running:
+            return False
+        self.last_poll[name] = self.restarted_at[name] = time.monotonic()
+        return True
+
+    def _run(self):
+        """Watchdog loop."""
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Error in watchdog: %s", e)
+            time.sleep(self.interval)
+
+    def start(self):
+        """Start the watchdog thread (once)."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def is_alive(self):
+        """Liveness: the watchdog, when started, has run recently."""
+        if self._beat is None:
+            return True
+        return time.monotonic() - self._beat < 3 * self.interval
+
+    def report(self):
+        """Current health signals; ages are in seconds and None when unknown."""
+        now = time.time()
+        dispatcher_depth = _dispatcher_queue_depth()
+        return {
+            "update_lag": self._recent_lag(now),
+            "seconds_since_last_update": None if self.last_update is None else round(now - self.last_update, 1),
+            "seconds_since_upstream_success": (None if self.last_upstream_success is None
+                                               else round(now - self.last_upstream_success, 1)),
+            "analytics_backlog": sum(t.analytics.pending_writes for t in served_tenants()),
+            "outbound_queue_depth": outbound.qsize(),
+            "dispatcher_queue_depth": dispatcher_depth or 0,
+            "polling": {name: u.running and not self._stalled(name, u) for name, u in self.updaters.items()},
+            "polling_restarts": self.polling_restarts,
+        }
+
+    def _recent_lag(self, now):
+        """Lag of the last update, unless it arrived too long ago to matter."""
+        if self.update_lag is None or now - self.last_update > UPDATE_LAG_WINDOW:
+            return None
+        return round(self.update_lag, 3)
+
+    def readiness_problems(self, report):
+        """Reasons the process should not receive traffic, if any."""
+        problems = []
+        if not all(report["polling"].values()):
+            problems.append("polling stopped")
+        if report["update_lag"] is not None and report["update_lag"] > READY_MAX_UPDATE_LAG:
+            problems.append("updates are lagging")
+        age = report["seconds_since_upstream_success"]
+        if age is not None and age > READY_MAX_RATES_AGE:
+            problems.append("exchange rates are stale")
+        if report["outbound_queue_depth"] + report["dispatcher_queue_depth"] > READY_MAX_QUEUE_DEPTH:
+            problems.append("queues are backed up")
+        if report["analytics_backlog"] > READY_MAX_ANALYTICS_BACKLOG:
+            problems.append("analytics writes are backed up")
+        return problems
+
+health = HealthMonitor()
+
+# --- KEEP ALIVE MODULE ---
+# Track the bot's start time for uptime display
+start_time = datetime.datetime.now()
+
+# Create Flask app with a name that can be imported by Gunicorn
+app = Flask(__name__)
+app.secret_key = os.environ.get("SESSION_SECRET", "currenzbot-secret-key")
+
+@app.before_request
+def start_background_threads():
+    """Gunicorn workers never call main(), so set up logging and memory sampling here."""
+    setup_logging()
+    memory_monitor.start()
+
+@app.route('/')
+def home():
+    """Home page to show the bot is alive."""
+    # Calculate uptime
+    uptime = datetime.datetime.now() - start_time
+    days, remainder = divmod(uptime.total_seconds(), 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    
+    uptime_str = f"{int(days)} days, {int(hours)} hours, {int(minutes)} minutes"
+    
+    return render_template('index.html', 
+                          uptime=uptime_str, 
+                          last_updated=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+@app.route('/ping')
+def ping():
+    """Endpoint for pinging the server to keep it alive."""
+    return "Pong! Bot is alive."
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: 200 while the process is responsive."""
+    alive = health.is_alive()
+    return jsonify({"status": "ok" if alive else "stalled"}), 200 if alive else 503
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 with the health signals, or 503 listing what is wrong."""
+    report = health.report()
+    problems = health.readiness_problems(report)
+    report["status"] = "ready" if not problems else "not ready"
+    report["problems"] = problems
+    return jsonify(report), 200 if not problems else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose counters and latency histograms in the Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def require_admin():
+    """Abort unless the request carries the ADMIN_TOKEN (via header or ?token=)."""
+    expected = os.environ.get("ADMIN_TOKEN")
+    if not expected:
+        abort(404)
+    supplied = request.headers.get("X-Admin-Token") or request.args.get("token") or ""
+    if not hmac.compare_digest(supplied, expected):
+        abort(403)
+
+@app.route('/debug/profile')
+def profile_endpoint():
+    """Download the aggregated handler profile (text, or pstats with ?format=pstats)."""
+    require_admin()
+    if request.args.get("reset") == "1":
+        profiler.reset()
+        return "Profile reset."
+    if request.args.get("format") == "pstats":
+        data = profiler.dump()
+        if data is None:
+            return "No profile samples collected yet.", 404
+        return Response(data, mimetype="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=currenzbot.pstats"})
+    return Response(profiler.report(), mimetype="text/plain")
+
+@app.route('/debug/slow')
+def slow_requests_endpoint():
+    """List the most recent slow requests."""
+    require_admin()
+    return jsonify(list(slow_requests))
+
+@app.route('/debug/memory')
+def memory_endpoint():
+    """Report RSS history, structure sizes and tracemalloc allocation data.
+
+    ?snapshot=1 takes a tracemalloc snapshot and diffs it against the previous
+    one; ?evict=1 runs the memory pressure hooks immediately.
+    """
+    require_admin()
+    if request.args.get("evict") == "1":
+        memory_monitor.relieve_pressure()
+    report = {
+        "rss_mb": round(get_rss_mb(), 1),
+        "soft_limit_mb": memory_monitor.soft_limit_mb or None,
+        "evictions": memory_monitor.evictions,
+        "rss_history": list(memory_monitor.history),
+        "structures": memory_monitor.structure_sizes(),
+        "tracemalloc": tracemalloc.is_tracing(),
+        "top_allocations": memory_monitor.top_allocations(),
+    }
+    if request.args.get("snapshot") == "1":
+        report["snapshot_diff"] = memory_monitor.snapshot_diff()
+    return jsonify(report)
+
+@app.route('/analytics')
+def analytics_dashboard():
+    """Display bot analytics dashboard."""
+    try:
+        # Get current month and year
+        current_month = datetime.datetime.now().strftime('%Y-%m')
+        
+        # Show the requested bot (?bot=name) or the first one
+        tenant = find_tenant(request.args.get("bot"))
+        bot_analytics = tenant.analytics
+        
+        # Get monthly stats
+        monthly_stats = bot_analytics.get_monthly_stats(current_month)
+        
+        # Get top commands
+        top_commands = bot_analytics.get_top_commands(limit=5)
+        
+        # Get popular conversions
+        popular_conversions = bot_analytics.get_popular_conversions(limit=5)
+        
+        # Rolling active users and monthly cohort retention
+        engagement = bot_analytics.get_engagement()
+        retention = bot_analytics.get_cohort_retention()
+        
+        # Upstream request budget
+        quota = upstream_quota.status()
+        
+        # Calculate uptime
+        uptime = datetime.datetime.now() - start_time
+        days, remainder = divmod(uptime.total_seconds(), 86400)
+        hours, remainder = divmod(remainder, 3600)
+        minutes, seconds = divmod(remainder, 60)
+        uptime_str = f"{int(days)} days, {int(hours)} hours, {int(minutes)} minutes"
+        
+        return render_template('analytics.html',
+                              monthly_stats=monthly_stats,
+                              top_commands=top_commands,
+                              popular_conversions=popular_conversions,
+                              engagement=engagement,
+                              retention=retention,
+                              quota=quota,
+                              uptime=uptime_str,
+                              current_month=current_month,
+                              bots=list(tenants),
+                              current_bot=tenant.name)
+    except Exception as e:
+        logger.error("Error loading analytics: %s", e)
+        return f"Error loading analytics: {str(e)}", 500
+
+def _export_date(name):
+    """Read a YYYY-MM-DD query argument, aborting with 400 if malformed."""
+    value = request.args.get(name)
+    if value:
+        try:
+            datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            abort(400)
+    return value
+
+@app.route('/analytics/export')
+def analytics_export():
+    """Stream analytics events as NDJSON or CSV.
+
+    ?from= and ?to= (YYYY-MM-DD, inclusive) limit the date range,
+    ?format=csv selects CSV and ?bot= picks a bot in multi-tenant mode. Events are read from the log as they are sent,
+    so memory use does not grow with the history.
+    """
+    require_admin()
+    start, end = _export_date("from"), _export_date("to")
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ndjson", "csv"):
+        abort(400)
+    events = find_tenant(request.args.get("bot")).analytics.events.iter_events(start, end)
+    
+    if export_format == "ndjson":
+        body = (json.dumps(event) + "\n" for event in events)
+        mimetype = "application/x-ndjson"
+    else:
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, ANALYTICS_EXPORT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            for event in events:
+                writer.writerow(event)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        body = generate()
+        mimetype = "text/csv"
+    
+    filename = f"currenzbot-analytics.{export_format}"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@app.route('/admin/reload-config', methods=['POST'])
+def reload_config_endpoint():
+    """Re-read CONFIG_FILE and apply it without restarting."""
+    require_admin()
+    try:
+        changed = reload_config()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"changed": changed})
+
+def run_flask():
+    """Run the Flask app in a separate thread."""
+    logger.info("Starting Flask server for keep-alive mechanism")
+    # Get port from environment variable (for Render compatibility)
+    # Use a different port for the keep-alive server in Replit to avoid conflicts
+    # with the main application running on port 5000
+    port = int(os.environ.get("PORT", 8080))
+    app.run(host='0.0.0.0', port=port, debug=False)
+
+def start_keep_alive():
+    """Start the keep-alive web server and the watchdog in separate threads."""
+    # Start web server thread
+    web_thread = threading.Thread(target=run_flask)
+    web_thread.daemon = True  # Set daemon to True so it exits when the main thread exits
+    web_thread.start()
+    logger.info("Keep-alive web server started")
+    
+    # The watchdog replaces the old self-ping: it checks the bot in-process
+    health.start()
+    logger.info("Watchdog started")
+
+# --- OUTBOUND QUEUE MODULE ---
+# Telegram allows roughly 30 messages per second per bot and about one message
+# per second per chat (20 per minute in groups). Every reply goes through this
+# scheduler so bursts are smoothed out instead of turning into 429 errors.
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+OUTBOUND_MAX_RETRIES = 3
+# Threads making Telegram API calls; the scheduler thread only hands them out
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", 8))
+
+# Priority lanes: lower numbers are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Sent in place of an answer that Telegram refused to deliver
+SEND_FAILED_TEXT = "Sorry, there was an error sending the reply. Please try again later."
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate` tokens per second."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until", "_lock")
+
+    def __init__(self, rate, capacity=None):
+        """Create a full bucket."""
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        """Add the tokens earned since the last refill."""
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def try_consume(self, tokens=1.0):
+        """Take tokens if available.
+
+        Returns 0.0 on success, otherwise the number of seconds until enough
+        tokens will be available (nothing is consumed in that case).
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def block(self, seconds):
+        """Hand out no tokens for `seconds` and start empty afterwards."""
+        with self._lock:
+            until = time.monotonic() + seconds
+            self.blocked_until = max(self.blocked_until, until)
+            self.tokens = 0.0
+            self.updated = self.blocked_until
+
+    def refund(self, tokens=1.0):
+        """Give back tokens taken for a call that was not made."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def is_full(self):
+        """Check whether the bucket has refilled completely."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+class RateLimitTable:
+    """Token buckets for many keys (users, chats) in one expiring table.
+
+    Each key only stores (tokens, updated, notified_until). Keys are kept in
+    least-recently-used order and an idle key is dropped once its bucket
+    would have refilled, since a missing key behaves like a full bucket.
+    """
+
+    def __init__(self, rate, capacity, max_size=100000):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.max_size = max_size
+        self.refill_time = self.capacity / self.rate
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_consume(self, key):
+        """Take a token for `key`.
+
+        Returns (0.0, False) on success, otherwise the seconds until a token is
+        available and whether the key should be told about it (once per
+        cool-down).
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            tokens, updated, notified_until = self._entries.pop(key, (self.capacity, now, 0.0))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1.0:
+                self._entries[key] = (tokens - 1.0, now, notified_until)
+                return 0.0, False
+            wait = (1.0 - tokens) / self.rate
+            notify = now >= notified_until
+            if notify:
+                notified_until = now + wait
+            self._entries[key] = (tokens, now, notified_until)
+            return wait, notify
+
+    def refund(self, key):
+        """Give back a token taken for an update that was dropped anyway."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                tokens, updated, notified_until = entry
+                self._entries[key] = (min(self.capacity, tokens + 1.0), updated, notified_until)
+
+    def _expire(self, now):
+        """Drop keys idle long enough to be full again, and the oldest over max_size."""
+        entries = self._entries
+        while entries:
+            key, (tokens, updated, notified_until) = next(iter(entries.items()))
+            if len(entries) <= self.max_size and now - updated < self.refill_time:
+                break
+            del entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+def _bot_key(func):
+    """Identify the bot making an API call from the bound method being called.
+
+    Telegram's limits apply per bot token, so each bot gets its own buckets.
+    """
+    owner = getattr(func, "__self__", None)
+    token = getattr(owner, "token", None)
+    if token is None:
+        # A message or callback query; never read Bot.bot, it calls getMe
+        token = getattr(getattr(owner, "bot", None), "token", None)
+    return token
+
+class _OutboundJob:
+    """A single queued Telegram API call."""
+
+    __slots__ = ("priority", "seq", "bot_key", "chat_id", "func", "args", "kwargs", "future",
+                 "attempts", "on_error")
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs, on_error=None):
+        self.priority = priority
+        self.seq = seq
+        self.bot_key = _bot_key(func)
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.on_error = on_error
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler:
+    """Send Telegram API calls from a pool of threads while respecting rate limits.
+
+    A scheduler thread orders calls by priority lane and then by submission
+    order. Each call must get a token from its bot's global bucket and from
+    its chat's bucket; calls for a throttled chat or bot are parked without
+    blocking the others. The calls themselves run on `workers` sender
+    threads, so one slow call does not hold up other chats, while calls for
+    the same chat still go out one at a time and in order.
+    A `RetryAfter` from Telegram re-queues the call after the requested delay
+    and pauses the bot's global bucket for as long.
+    Calls are sent after the handler has returned, so a call that finally
+    fails is reported through its Future and its `on_error` callback.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES,
+                 workers=OUTBOUND_WORKERS):
+        """Initialize the scheduler; its threads start on first use."""
+        self.global_rate = global_rate
+        self.global_buckets = {}
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self._senders = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbound-sender")
+        self._ready = []
+        self._delayed = []
+        # Chats with a call being sent, and calls queued behind it, by (bot, chat)
+        self._in_flight = {}
+        self._waiting = defaultdict(deque)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._last_prune = time.monotonic()
+
+    def submit(self, chat_id, func, *args, priority=PRIORITY_INTERACTIVE, trace=None,
+               on_error=None, **kwargs):
+        """Queue `func(*args, **kwargs)` for `chat_id` and return a Future of its result.
+
+        The call is attributed to `trace`, or to the current thread's trace.
+        `on_error(exc)` is called from the sender thread if the call fails for
+        good (after any flood-control retries).
+        """
+        job = _OutboundJob(priority, next(self._seq), chat_id, func, args, kwargs, on_error)
+        trace = trace or current_trace()
+        TELEGRAM_API_CALLS.inc(trace.handler if trace is not None else "background")
+        if trace is not None:
+            queued = time.perf_counter()
+            trace.begin_send()
+
+            def sent(_):
+                trace.record("send", time.perf_counter() - queued)
+                trace.end_send()
+
+            job.future.add_done_callback(sent)
+        with self._cond:
+            heapq.heappush(self._ready, job)
+            self._ensure_worker()
+            self._cond.notify()
+        return job.future
+
+    def qsize(self):
+        """Number of calls waiting to be sent or being sent."""
+        with self._cond:
+            return (len(self._ready) + len(self._delayed) + len(self._in_flight)
+                    + sum(len(q) for q in self._waiting.values()))
+
+    def _ensure_worker(self):
+        """Start the worker thread if it is not running yet."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="outbound-scheduler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _global_bucket(self, bot_key):
+        """Get or create the token bucket for a bot."""
+        bucket = self.global_buckets.get(bot_key)
+        if bucket is None:
+            bucket = self.global_buckets[bot_key] = TokenBucket(self.global_rate)
+        return bucket
+
+    def _chat_bucket(self, bot_key, chat_id):
+        """Get or create the token bucket for a chat of a bot."""
+        key = (bot_key, chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[key] = bucket
+        return bucket
+
+    def _prune_buckets(self, now):
+        """Drop buckets of idle chats so the table does not grow forever."""
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for key in [k for k, b in self.chat_buckets.items() if b.is_full()]:
+            del self.chat_buckets[key]
+
+    def _next_job(self):
+        """Block until a job is ready to be attempted and return it."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    heapq.heappush(self._ready, heapq.heappop(self._delayed)[1])
+                if self._ready:
+                    self._prune_buckets(now)
+                    return heapq.heappop(self._ready)
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _defer(self, job, delay):
+        """Park a job until `delay` seconds from now."""
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, job))
+            self._cond.notify()
+
+    def _claim_chat(self, job):
+        """Reserve the job's chat; False (and the job is parked) if a call is in flight."""
+        if job.chat_id is None:
+            return True
+        key = (job.bot_key, job.chat_id)
+        with self._cond:
+            holder = self._in_flight.get(key)
+            if holder is not None and holder is not job:
+                self._waiting[key].append(job)
+                return False
+            self._in_flight[key] = job
+            return True
+
+    def _release_chat(self, job):
+        """Free the job's chat and queue the next call waiting for it."""
+        if job.chat_id is None:
+            return
+        key = (job.bot_key, job.chat_id)
+        with self._cond:
+            self._in_flight.pop(key, None)
+            waiting = self._waiting.get(key)
+            if waiting:
+                heapq.heappush(self._ready, waiting.popleft())
+                if not waiting:
+                    del self._waiting[key]
+                self._cond.notify()
+
+    def _run(self):
+        """Scheduler loop: take jobs in priority order and hand them to the senders."""
+        while True:
+            job = self._next_job()
+            if not self._claim_chat(job):
+                continue
+
+            chat_bucket = None
+            if job.chat_id is not None:
+                chat_bucket = self._chat_bucket(job.bot_key, job.chat_id)
+                wait = chat_bucket.try_consume()
+                if wait:
+                    self._defer(job, wait)
+                    continue
+
+            wait = self._global_bucket(job.bot_key).try_consume()
+            if wait:
+                if chat_bucket is not None:
+                    chat_bucket.refund()
+                self._defer(job, wait)
+                continue
+
+            self._senders.submit(self._execute, job)
+
+    def _execute(self, job):
+        """Perform the API call on a sender thread and resolve its future."""
+        try:
+            result = job.func(*job.args, **job.kwargs)
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            job.attempts += 1
+            if retry_after is not None and job.attempts <= self.max_retries:
+                logger.warning("Flood control for chat %s, retrying in %ss", job.chat_id, retry_after)
+                # Telegram throttles the whole bot, so stop its other calls too;
+                # the job keeps its chat reserved so later messages stay behind it
+                self._global_bucket(job.bot_key).block(float(retry_after))
+                self._defer(job, float(retry_after))
+                return
+            self._release_chat(job)
+            logger.error("Error sending message to chat %s: %s", job.chat_id, e)
+            job.future.set_exception(e)
+            if job.on_error is not None:
+                try:
+                    job.on_error(e)
+                except Exception:
+                    logger.exception("Error in send failure callback for chat %s", job.chat_id)
+        else:
+            self._release_chat(job)
+            job.future.set_result(result)
+
+# Shared scheduler used by all handlers
+outbound = OutboundScheduler()
+
+metrics.gauge("currenzbot_outbound_queue_depth", "Telegram API calls waiting to be sent",
+              outbound.qsize)
+memory_monitor.register_structure("outbound_chat_buckets", lambda: len(outbound.chat_buckets))
+memory_monitor.register_structure("slow_requests", lambda: len(slow_requests))
+
+def _chat_id(update):
+    """Get the chat id an update should be answered in."""
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat else None
+
+def reply_text(update, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Queue `update.message.reply_text`; drop-in for the direct call."""
+    return outbound.submit(_chat_id(update), update.message.reply_text, text,
+                           priority=priority, **kwargs)
+
+def reply_markdown_v2(update, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Queue `update.message.reply_markdown_v2`; drop-in for the direct call."""
+    return outbound.submit(_chat_id(update), update.message.reply_markdown_v2, text,
+                           priority=priority, **kwargs)
+
+def edit_message_text(update, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """Queue `update.callback_query.edit_message_text`."""
+    return outbound.submit(_chat_id(update), update.callback_query.edit_message_text, text,
+                           priority=priority, **kwargs)
+
+def edit_message_reply_markup(update, reply_markup, priority=PRIORITY_INTERACTIVE):
+    """Queue `update.callback_query.edit_message_reply_markup`."""
+    return outbound.submit(_chat_id(update), update.callback_query.edit_message_reply_markup,
+                           priority=priority, reply_markup=reply_markup)
+
+def _chain_future(source, target):
+    """Resolve `target` with the outcome of `source` once it completes."""
+    def copy(done):
+        if done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+    source.add_done_callback(copy)
+
+class PendingReply:
+    """The one answer to an update, optionally preceded by a placeholder.
+
+    Handlers that may be slow call show_placeholder() first; the final
+    send() then edits the placeholder in place instead of posting a second
+    message, so every request costs at most two API calls and leaves one
+    message in the chat. Without a placeholder the answer is a plain reply.
+    If the answer cannot be delivered (e.g. Telegram rejects its markup), a
+    plain error message is sent instead so the user is not left waiting.
+    """
+
+    def __init__(self, update, priority=PRIORITY_INTERACTIVE):
+        self.update = update
+        self.priority = priority
+        self.placeholder = None
+        self.trace = current_trace()
+
+    def _report_failure(self, error):
+        """Tell the user the answer could not be sent; called by the sender thread."""
+        if self.update.message is not None:
+            outbound.submit(_chat_id(self.update), self.update.message.reply_text,
+                            SEND_FAILED_TEXT, priority=self.priority, trace=self.trace)
 
-# --- KEEP ALIVE MODULE ---
-# Track the bot's start time for uptime display
-start_time = datetime.datetime.now()
+    def show_placeholder(self, text):
+        """Send a short "working on it" message."""
+        if self.placeholder is None:
+            self.placeholder = reply_text(self.update, text, priority=self.priority)
 
-# Create Flask app with a name that can be imported by Gunicorn
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "currenzbot-secret-key")
+    def send(self, text, **kwargs):
+        """Deliver the final answer as plain text."""
+        return self._deliver(text, kwargs)
 
-@app.route('/')
-def home():
-    """Home page to show the bot is alive."""
-    # Calculate uptime
-    uptime = datetime.datetime.now() - start_time
-    days, remainder = divmod(uptime.total_seconds(), 86400)
-    hours, remainder = divmod(remainder, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    
-    uptime_str = f"{int(days)} days, {int(hours)} hours, {int(minutes)} minutes"
-    
-    return render_template('index.html', 
-                          uptime=uptime_str, 
-                          last_updated=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    def send_markdown(self, text, **kwargs):
+        """Deliver the final answer formatted as MarkdownV2."""
+        kwargs["parse_mode"] = "MarkdownV2"
+        return self._deliver(text, kwargs)
 
-@app.route('/ping')
-def ping():
-    """Endpoint for pinging the server to keep it alive."""
-    return "Pong! Bot is alive."
+    def _deliver(self, text, kwargs):
+        """Reply, or edit the placeholder once it has been sent."""
+        chat_id = _chat_id(self.update)
+        if self.placeholder is None:
+            result = outbound.submit(chat_id, self.update.message.reply_text, text,
+                                     priority=self.priority, on_error=self._report_failure,
+                                     **kwargs)
+        else:
+            result = Future()
 
-@app.route('/analytics')
-def analytics_dashboard():
-    """Display bot analytics dashboard."""
-    try:
-        # Get current month and year
-        current_month = datetime.datetime.now().strftime('%Y-%m')
-        
-        # Get monthly stats
-        monthly_stats = analytics.get_monthly_stats(current_month)
-        
-        # Get top commands
-        top_commands = analytics.get_top_commands(limit=5)
-        
-        # Get popular conversions
-        popular_conversions = analytics.get_popular_conversions(limit=5)
-        
-        # Calculate uptime
-        uptime = datetime.datetime.now() - start_time
-        days, remainder = divmod(uptime.total_seconds(), 86400)
-        hours, remainder = divmod(remainder, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        uptime_str = f"{int(days)} days, {int(hours)} hours, {int(minutes)} minutes"
-        
-        return render_template('analytics.html',
-                              monthly_stats=monthly_stats,
-                              top_commands=top_commands,
-                              popular_conversions=popular_conversions,
-                              uptime=uptime_str,
-                              current_month=current_month)
-    except Exception as e:
-        logger.error(f"Error loading analytics: {str(e)}")
-        return f"Error loading analytics: {str(e)}", 500
+            def edit(placeholder):
+                if placeholder.exception() is not None:
+                    # The placeholder never arrived, so send the answer normally
+                    follow_up = outbound.submit(chat_id, self.update.message.reply_text, text,
+                                                priority=self.priority, trace=self.trace,
+                                                on_error=self._report_failure, **kwargs)
+                else:
+                    follow_up = outbound.submit(chat_id, placeholder.result().edit_text, text,
+                                                priority=self.priority, trace=self.trace,
+                                                on_error=self._report_failure, **kwargs)
+                _chain_future(follow_up, result)
 
-def run_flask():
-    """Run the Flask app in a separate thread."""
-    logger.info("Starting Flask server for keep-alive mechanism")
-    # Get port from environment variable (for Render compatibility)
-    # Use a different port for the keep-alive server in Replit to avoid conflicts
-    # with the main application running on port 5000
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port, debug=False)
+            self.placeholder.add_done_callback(edit)
 
-def ping_server():
-    """Ping the server every 5 minutes to keep it alive."""
-    # Try to get Replit domain from environment, or use localhost for testing
-    host = os.environ.get("REPLIT_DOMAIN", "localhost:8080")
-    
-    # Use HTTPS for Replit domain, HTTP for localhost
-    url = f"https://{host}/ping" if "replit" in host else "http://localhost:8080/ping"
-    
-    logger.info(f"Keep-alive pinger will ping: {url}")
-    
-    while True:
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        try:
-            response = requests.get(url)
-            logger.info(f"[{current_time}] Ping status: {response.status_code} {response.text}")
-        except Exception as e:
-            logger.error(f"[{current_time}] Error pinging server: {str(e)}")
-        
-        # Sleep for 5 minutes (300 seconds)
-        # This helps keep the Replit instance alive on the free tier
-        time.sleep(300)
+        trace = self.trace
+        if trace is not None:
+            # The edit is only queued once the placeholder arrives
+            trace.begin_send()
 
-def start_keep_alive():
-    """Start the keep-alive web server and pinger in separate threads."""
-    # Start web server thread
-    web_thread = threading.Thread(target=run_flask)
-    web_thread.daemon = True  # Set daemon to True so it exits when the main thread exits
-    web_thread.start()
-    logger.info("Keep-alive web server started")
-    
-    # Start pinger thread
-    pinger_thread = threading.Thread(target=ping_server)
-    pinger_thread.daemon = True
-    pinger_thread.start()
-    logger.info("Keep-alive pinger started")
+            def delivered(_):
+                REPLY_LATENCY.observe(time.perf_counter() - trace.started, trace.handler)
+                trace.end_send()
+
+            result.add_done_callback(delivered)
+        return result
+
+def send_message(bot, chat_id, text, priority=PRIORITY_BULK, **kwargs):
+    """Queue a message that is not a reply, e.g. a broadcast or an alert."""
+    return outbound.submit(chat_id, bot.send_message, chat_id, text,
+                           priority=priority, **kwargs)
 
 # --- TELEGRAM BOT MODULE ---
-try:
-    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-    from telegram.ext import (
-        Updater, CommandHandler, MessageHandler, CallbackQueryHandler,
-        CallbackContext, ConversationHandler, Filters
-    )
-except ImportError:
-    # Handle case where python-telegram-bot isn't installed
-    logger.error("python-telegram-bot not installed. Please install it with 'pip install python-telegram-bot==13.15'")
-    # Define mock classes to avoid errors in the code below
-    class Update: pass
-    class CallbackContext: pass
-    class ConversationHandler:
-        END = 0
-    # Exit with error
-    import sys
-    print("ERROR: python-telegram-bot not installed. Please install it with 'pip install python-telegram-bot==13.15'")
-    if not os.environ.get("TESTING") == "1":
-        sys.exit(1)
+telegram_loaded = False
+
+def load_telegram():
+    """Import python-telegram-bot into the module namespace (once)."""
+    global telegram_loaded
+    global Update, InlineKeyboardButton, InlineKeyboardMarkup
+    global Updater, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler
+    global CallbackContext, ConversationHandler, Filters, DispatcherHandlerStop
+    if telegram_loaded:
+        return
+    started = time.perf_counter()
+    try:
+        from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+        from telegram.ext import (
+            Updater, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler,
+            CallbackContext, ConversationHandler, Filters, DispatcherHandlerStop
+        )
+    except ImportError:
+        # Handle case where python-telegram-bot isn't installed
+        logger.error("python-telegram-bot not installed. Please install it with 'pip install python-telegram-bot==13.15'")
+        # Define mock classes to avoid errors in the code below
+        class Update: pass
+        class CallbackContext: pass
+        class ConversationHandler:
+            END = 0
+        # Exit with error
+        import sys
+        print("ERROR: python-telegram-bot not installed. Please install it with 'pip install python-telegram-bot==13.15'")
+        if not os.environ.get("TESTING") == "1":
+            sys.exit(1)
+    telegram_loaded = True
+    record_startup_phase("import_telegram", started)
+
+if not LAZY_STARTUP:
+    load_telegram()
 
 # Conversation states
 SELECTING_BASE, SELECTING_TARGET, ENTERING_AMOUNT = range(3)
 
+# How long an unfinished /convert wizard is kept (seconds) and how many may exist
+CONVERSATION_TIMEOUT = int(os.environ.get("CONVERSATION_TIMEOUT", 600))
+CONVERSATION_MAX_SESSIONS = int(os.environ.get("CONVERSATION_MAX_SESSIONS", 10000))
+
+class ConversionState:
+    """Choices made so far in one user's /convert wizard."""
+
+    __slots__ = ("base_currency", "target_currency", "expires_at")
+
+    def __init__(self, expires_at):
+        self.base_currency = None
+        self.target_currency = None
+        self.expires_at = expires_at
+
+class ConversationStateStore:
+    """Per-user wizard state with a TTL and a maximum size.
+
+    The records are kept in the state backend, which enforces the TTL, so
+    with a shared backend any process can continue a wizard. start(), get()
+    and save() extend the entry's lifetime; a membership test does not. When
+    the store is full the least recently used entries are dropped, so
+    abandoned wizards cannot pile up.
+    """
+
+    def __init__(self, ttl=CONVERSATION_TIMEOUT, max_size=CONVERSATION_MAX_SESSIONS, backend=None,
+                 namespace="conversation"):
+        self.ttl = ttl
+        self.namespace = namespace
+        self.max_size = max_size
+        self.backend = backend if backend is not None else MemoryBackend()
+
+    def start(self, user_id):
+        """Create a fresh state for a user, replacing any previous one."""
+        state = ConversionState(time.monotonic() + self.ttl)
+        self.save(user_id, state)
+        self.backend.trim(self.namespace, self.max_size)
+        return state
+
+    def get(self, user_id):
+        """Get a user's live state and extend its lifetime, or None."""
+        record = self.backend.get(self.namespace, user_id)
+        if record is None:
+            return None
+        state = ConversionState(time.monotonic() + self.ttl)
+        state.base_currency = record["base_currency"]
+        state.target_currency = record["target_currency"]
+        self.save(user_id, state)
+        return state
+
+    def save(self, user_id, state):
+        """Persist changes made to a state."""
+        self.backend.set(self.namespace, user_id, {
+            "base_currency": state.base_currency,
+            "target_currency": state.target_currency,
+        }, ttl=self.ttl)
+
+    def discard(self, user_id):
+        """Forget a user's state."""
+        self.backend.delete(self.namespace, user_id)
+
+    def purge_expired(self):
+        """Drop every expired state."""
+        self.backend.purge_expired()
+
+    def __len__(self):
+        return self.backend.count(self.namespace)
+
+    def __contains__(self, user_id):
+        """Whether a user has a live state, without extending its lifetime."""
+        return self.backend.get(self.namespace, user_id) is not None
+
 # User data storage
-user_conversion_state = {}
+user_conversion_state = ConversationStateStore(backend=storage)
+memory_monitor.register_structure("user_conversion_state", lambda: len(user_conversion_state))
+memory_monitor.register_pressure_hook(user_conversion_state.purge_expired)
+
+class BotTenant:
+    """Settings and per-bot state of one bot served by this process.
+
+    Every bot shares the rate cache, HTTP pool and outbound sender; analytics
+    and /convert wizard state are kept per bot. Analytics are created on
+    first use, so a bot that is never served never loads its data.
+    """
+
+    def __init__(self, name, token, wise_referral_link=None, popular_currencies=None,
+                 analytics=None, conversations=None):
+        self.name = name
+        self.token = token
+        # None means "use the global setting", which a config reload can change
+        self._wise_referral_link = wise_referral_link
+        self._popular_currencies = [c.upper() for c in popular_currencies] if popular_currencies else None
+        self._analytics = analytics
+        self._analytics_lock = threading.Lock()
+        self.conversations = conversations or ConversationStateStore(
+            backend=storage, namespace=f"conversation:{name}")
+        # Keyboards that depend on this bot's settings, filled by build_keyboards
+        self.keyboards = {}
+        if conversations is None:
+            memory_monitor.register_structure(f"conversations:{name}", lambda: len(self.conversations))
+            memory_monitor.register_pressure_hook(self.conversations.purge_expired)
+
+    @property
+    def analytics(self):
+        """This bot's analytics, created and registered with the memory monitor on first use."""
+        if self._analytics is None:
+            with self._analytics_lock:
+                if self._analytics is None:
+                    self._analytics = self._create_analytics()
+        return self._analytics
+
+    def _create_analytics(self):
+        # The single-bot setup keeps the file names from before multi-bot support
+        default = self.name == "default"
+        analytics = BotAnalytics(lazy=LAZY_STARTUP, backend=storage, name=None if default else self.name)
+        suffix = "" if default else f":{self.name}"
+        for table in ("users", "conversions", "commands"):
+            memory_monitor.register_structure(f"analytics_{table}{suffix}",
+                                              lambda table=table: len(analytics.data[table]))
+        memory_monitor.register_pressure_hook(analytics.compact)
+        return analytics
+
+    @property
+    def wise_referral_link(self):
+        return self._wise_referral_link or WISE_REFERRAL_LINK
+
+    @property
+    def popular_currencies(self):
+        return self._popular_currencies or POPULAR_CURRENCIES
+
+# The single-bot configuration, also used where no bot is known (e.g. tests)
+default_tenant = BotTenant("default", TELEGRAM_TOKEN, conversations=user_conversion_state)
+# Bots being served, by name; filled by create_application
+tenants = {}
+
+def load_tenants():
+    """The bots to run: those listed in BOTS_CONFIG, or the single default bot."""
+    if not BOTS_CONFIG:
+        loaded = [default_tenant]
+    else:
+        with open(BOTS_CONFIG, 'r') as f:
+            configs = json.load(f)
+        loaded = [
+            BotTenant(
+                config.get("name") or f"bot{i + 1}",
+                config["token"],
+                wise_referral_link=config.get("wise_referral_link"),
+                popular_currencies=config.get("popular_currencies"),
+            )
+            for i, config in enumerate(configs)
+        ]
+    for tenant in loaded:
+        # Create the served bots' analytics up front, loading them in the background with LAZY_STARTUP
+        analytics = tenant.analytics
+        if LAZY_STARTUP:
+            analytics.preload_async()
+    return loaded
+
+def get_tenant(context):
+    """The bot an update was received by, from the dispatcher's bot_data."""
+    bot_data = getattr(context, "bot_data", None)
+    return bot_data.get("tenant", default_tenant) if bot_data else default_tenant
+
+def find_tenant(name=None):
+    """A served bot by name; defaults to the first one."""
+    if name and name in tenants:
+        return tenants[name]
+    return next(iter(tenants.values()), default_tenant)
+
+def served_tenants():
+    """The bots served by this process, or the default bot where none are (e.g. a web worker)."""
+    return list(tenants.values()) or [default_tenant]
+
+# Dispatchers of the running bots, used for queue depth reporting
+active_dispatchers = []
+
+def _dispatcher_queue_depth():
+    """Number of updates waiting in the dispatcher queues."""
+    if not active_dispatchers:
+        return None
+    return sum(d.update_queue.qsize() for d in active_dispatchers)
+
+metrics.gauge("currenzbot_dispatcher_queue_depth", "Updates waiting to be dispatched",
+              _dispatcher_queue_depth)
+
+def instrument_handler(func):
+    """Wrap a handler callback to trace it and record its latency and outcome."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(update, context):
+        user = getattr(update, "effective_user", None)
+        trace = start_trace(name, user.id if user else None)
+        status = "error"
+        try:
+            result = profiler.run(func, update, context)
+            status = "ok"
+            return result
+        finally:
+            finish_trace(trace)
+            HANDLER_LATENCY.observe(trace.duration, name)
+            HANDLER_REQUESTS.inc(name, status)
+            access_logger.info(
+                "%s %s in %.1f ms", name, status, trace.duration * 1000,
+                extra={
+                    "handler": name,
+                    "user": user_hash(trace.user_id),
+                    "latency": round(trace.duration, 4),
+                    "cache_hit": trace.cache_hit,
+                },
+            )
+
+    return wrapper
+
+# Per-user and per-chat flood protection, applied before any handler runs.
+# Rates are in updates per second; the burst is how many may arrive at once.
+USER_RATE_LIMIT = float(os.environ.get("USER_RATE_LIMIT", 1))
+USER_RATE_BURST = float(os.environ.get("USER_RATE_BURST", 10))
+CHAT_RATE_LIMIT = float(os.environ.get("CHAT_RATE_LIMIT", 3))
+CHAT_RATE_BURST = float(os.environ.get("CHAT_RATE_BURST", 20))
+
+user_rate_limits = RateLimitTable(USER_RATE_LIMIT, USER_RATE_BURST)
+chat_rate_limits = RateLimitTable(CHAT_RATE_LIMIT, CHAT_RATE_BURST)
+memory_monitor.register_structure("user_rate_limits", lambda: len(user_rate_limits))
+memory_monitor.register_structure("chat_rate_limits", lambda: len(chat_rate_limits))
+
+def rate_limit_updates(update, context):
+    """Drop updates from users or group chats that exceed their rate limit.
+
+    Registered in handler group -1 so it runs before every other handler;
+    raising DispatcherHandlerStop keeps the update from reaching them. The
+    sender gets one cool-down notice per cool-down period. Buckets are kept
+    per bot, so a flood on one bot does not throttle the same user elsewhere.
+    """
+    user = update.effective_user
+    chat = update.effective_chat
+    bot = get_tenant(context).name
+    wait, notify, scope = 0.0, False, None
+    if user is not None:
+        wait, notify = user_rate_limits.try_consume((bot, user.id))
+        scope = "user"
+    if not wait and chat is not None and chat.type != "private":
+        wait, notify = chat_rate_limits.try_consume((bot, chat.id))
+        scope = "chat"
+        if wait and user is not None:
+            # The group is throttled; don't charge the sender for a dropped update
+            user_rate_limits.refund((bot, user.id))
+    if not wait:
+        return
+    
+    RATE_LIMITED.inc(scope)
+    if notify:
+        notice = f"⏳ Slow down a little! Please try again in {max(1, round(wait))} seconds."
+        if update.callback_query:
+            outbound.submit(_chat_id(update), update.callback_query.answer, notice,
+                            priority=PRIORITY_BULK)
+        elif update.message:
+            reply_text(update, notice, priority=PRIORITY_BULK)
+    raise DispatcherHandlerStop()
+
+# Inline keyboards are built once and reused; they only change when the
+# currency catalog grows
+CURRENCY_PAGE_SIZE = 24
+_keyboards = {}
+_keyboards_lock = threading.Lock()
+
+def _currency_grid(codes, columns=3):
+    """Rows of currency buttons whose callback data is the currency code."""
+    buttons = [InlineKeyboardButton(f"{get_currency_emoji(c)} {c}", callback_data=c) for c in codes]
+    return [buttons[i:i + columns] for i in range(0, len(buttons), columns)]
+
+def _wise_markup(label, link=None):
+    """A single Wise referral button."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, url=link or WISE_REFERRAL_LINK)]])
+
+def build_keyboards():
+    """Build every reusable keyboard and swap them in at once.
+
+    Currency pages are shared; the popular picker and referral buttons are
+    built for each bot.
+    """
+    load_telegram()
+    for tenant in {default_tenant, *tenants.values()}:
+        tenant.keyboards = {
+            "popular": InlineKeyboardMarkup(
+                _currency_grid(tenant.popular_currencies)
+                + [[InlineKeyboardButton("🔎 All currencies", callback_data="page:0")]]
+            ),
+            "wise_start": _wise_markup(f"{EMOJI['rocket']} Convert currency with best rate",
+                                       tenant.wise_referral_link),
+            "wise": _wise_markup(f"{EMOJI['rocket']} Convert with best rate", tenant.wise_referral_link),
+        }
+    codes = currency_index.codes()
+    pages = max(1, -(-len(codes) // CURRENCY_PAGE_SIZE))
+    built = {}
+    for page in range(pages):
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"page:{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="page:popular"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"page:{page + 1}"))
+        chunk = codes[page * CURRENCY_PAGE_SIZE:(page + 1) * CURRENCY_PAGE_SIZE]
+        built[f"page:{page}"] = InlineKeyboardMarkup(_currency_grid(chunk) + [nav])
+    global _keyboards
+    with _keyboards_lock:
+        _keyboards = built
+
+def get_keyboard(name, tenant=None):
+    """A prebuilt keyboard ("popular", "wise", "wise_start" or "page:N") for a bot."""
+    if not _keyboards:
+        build_keyboards()
+    tenant = tenant or default_tenant
+    return tenant.keyboards.get(name) or _keyboards.get(name)
+
+@functools.lru_cache(maxsize=256)
+def wise_keyboard(base_currency, link=None):
+    """Wise referral button labelled with a base currency."""
+    return _wise_markup(f"{EMOJI['rocket']} Convert {base_currency} with best rate", link)
+
+@functools.lru_cache(maxsize=1024)
+def search_keyboard(codes):
+    """Keyboard listing currency search results (a tuple of codes)."""
+    return InlineKeyboardMarkup(
+        _currency_grid(codes) + [[InlineKeyboardButton("🔎 All currencies", callback_data="page:0")]]
+    )
+
+def refresh_currency_catalog(currencies):
+    """Index newly seen currencies and rebuild the picker pages if any were added."""
+    added = [code for code, name in currencies.items() if currency_index.add(code, name)]
+    if added:
+        build_keyboards()
 
 def start(update: Update, context: CallbackContext) -> None:
     """Send a welcome message when the command /start is issued."""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # Track user analytics
-    analytics.track_user(
+    tenant.analytics.track_user(
         user.id, 
         username=user.username, 
         first_name=user.first_name
     )
-    analytics.track_command('start', user.id)
+    tenant.analytics.track_command('start', user.id)
     
     welcome_message = (
         f"{EMOJI['sparkles']} *Welcome to CurrenzBot!* {EMOJI['sparkles']}\n\n"
@@ -547,24 +3746,17 @@ def start(update: Update, context: CallbackContext) -> None:
         f"Use /help to see all available commands."
     )
     
-    # Create a keyboard with the Wise referral button
-    keyboard = [
-        [InlineKeyboardButton(
-            f"{EMOJI['rocket']} Convert currency with best rate", 
-            url=WISE_REFERRAL_LINK
-        )]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    update.message.reply_markdown_v2(welcome_message, reply_markup=reply_markup)
+    # Reuse the prebuilt Wise referral keyboard
+    reply_markdown_v2(update, welcome_message, reply_markup=get_keyboard("wise_start", tenant))
 
 def help_command(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # Track analytics
-    analytics.track_user(user.id, username=user.username, first_name=user.first_name)
-    analytics.track_command('help', user.id)
+    tenant.analytics.track_user(user.id, username=user.username, first_name=user.first_name)
+    tenant.analytics.track_command('help', user.id)
     
     help_text = (
         f"{EMOJI['information']} *CurrenzBot Help* {EMOJI['information']}\n\n"
@@ -581,15 +3773,49 @@ def help_command(update: Update, context: CallbackContext) -> None:
         f"Example: `100 USD to EUR` or `50 USDT in BDT`"
     )
     
-    update.message.reply_markdown_v2(help_text)
+    reply_markdown_v2(update, help_text)
+
+# Rendered /rates messages by base currency, reused while the rates object is unchanged
+_rendered_rates = {}
+memory_monitor.register_structure("rendered_rates", lambda: len(_rendered_rates))
+memory_monitor.register_pressure_hook(_rendered_rates.clear)
+
+def render_rates_message(base_currency, rates, popular_currencies=None):
+    """Build the /rates message, reusing the last rendering for the same rates."""
+    popular_currencies = popular_currencies or POPULAR_CURRENCIES
+    key = (base_currency, tuple(popular_currencies))
+    cached = _rendered_rates.get(key)
+    if cached is not None and cached[0] is rates:
+        return cached[1]
+    
+    # Create the response message
+    response = f"{get_currency_emoji(base_currency)} *{base_currency} Exchange Rates*\n\n"
+    
+    # Add popular currencies first
+    response += "*Popular Currencies:*\n"
+    for currency in popular_currencies:
+        if currency != base_currency and currency in rates:
+            emoji = get_currency_emoji(currency)
+            response += f"{emoji} *{currency}*: {rates[currency]:.4f}\n"
+    
+    # Add other currencies
+    response += "\n*Other Currencies:*\n"
+    for currency, rate in rates.items():
+        if currency not in popular_currencies and currency != base_currency:
+            emoji = get_currency_emoji(currency)
+            response += f"{emoji} *{currency}*: {rate:.4f}\n"
+    
+    _rendered_rates[key] = (rates, response)
+    return response
 
 def rates_command(update: Update, context: CallbackContext) -> None:
     """Get exchange rates for a base currency."""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # Track analytics
-    analytics.track_user(user.id, username=user.username, first_name=user.first_name)
-    analytics.track_command('rates', user.id)
+    tenant.analytics.track_user(user.id, username=user.username, first_name=user.first_name)
+    tenant.analytics.track_command('rates', user.id)
     
     base_currency = DEFAULT_BASE_CURRENCY
     
@@ -597,107 +3823,95 @@ def rates_command(update: Update, context: CallbackContext) -> None:
     if context.args and len(context.args) > 0:
         base_currency = context.args[0].upper()
     
-    update.message.reply_text(f"Fetching exchange rates for {base_currency}...")
+    # Only show a placeholder when the answer has to come from upstream
+    reply = PendingReply(update)
+    if not rate_cache.contains(base_currency):
+        reply.show_placeholder(f"Fetching exchange rates for {base_currency}...")
     
     try:
         # Get the exchange rates
         rates = get_exchange_rates(base_currency)
         
         if rates:
-            # Create the response message
-            response = f"{get_currency_emoji(base_currency)} *{base_currency} Exchange Rates*\n\n"
-            
-            # Add popular currencies first
-            response += "*Popular Currencies:*\n"
-            for currency in POPULAR_CURRENCIES:
-                if currency != base_currency and currency in rates:
-                    emoji = get_currency_emoji(currency)
-                    response += f"{emoji} *{currency}*: {rates[currency]:.4f}\n"
-            
-            # Add other currencies
-            response += "\n*Other Currencies:*\n"
-            for currency, rate in rates.items():
-                if currency not in POPULAR_CURRENCIES and currency != base_currency:
-                    emoji = get_currency_emoji(currency)
-                    response += f"{emoji} *{currency}*: {rate:.4f}\n"
-            
-            # Add Wise referral button
-            keyboard = [
-                [InlineKeyboardButton(
-                    f"{EMOJI['rocket']} Convert {base_currency} with best rate", 
-                    url=WISE_REFERRAL_LINK
-                )]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            with trace_span("build"):
+                response = render_rates_message(base_currency, rates, tenant.popular_currencies)
+                reply_markup = wise_keyboard(base_currency, tenant.wise_referral_link)
             
-            update.message.reply_markdown_v2(response, reply_markup=reply_markup)
+            reply.send_markdown(response, reply_markup=reply_markup)
         else:
-            update.message.reply_text(
+            reply.send(
                 f"Sorry, I couldn't get exchange rates for {base_currency}. "
                 "Please try a different currency code."
             )
     except Exception as e:
-        logger.error(f"Error in rates_command: {e}")
-        update.message.reply_text(
+        logger.error("Error in rates_command: %s", e)
+        reply.send(
             f"Sorry, there was an error getting exchange rates. "
             "Please try again later."
         )
 
 def currencies_command(update: Update, context: CallbackContext) -> None:
     """List supported currencies."""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # Track analytics
-    analytics.track_user(user.id, username=user.username, first_name=user.first_name)
-    analytics.track_command('currencies', user.id)
+    tenant.analytics.track_user(user.id, username=user.username, first_name=user.first_name)
+    tenant.analytics.track_command('currencies', user.id)
     
-    update.message.reply_text("Fetching supported currencies...")
+    reply = PendingReply(update)
+    if not rate_cache.contains("USD"):
+        reply.show_placeholder("Fetching supported currencies...")
     
     try:
         currencies = get_supported_currencies()
         
         if currencies:
-            # Create the response message
-            response = f"{EMOJI['globe']} *Supported Currencies*\n\n"
+            refresh_currency_catalog(currencies)
+            with trace_span("build"):
+                # Create the response message
+                response = f"{EMOJI['globe']} *Supported Currencies*\n\n"
             
-            # Add popular currencies first
-            response += "*Popular Currencies:*\n"
-            for currency in POPULAR_CURRENCIES:
-                emoji = get_currency_emoji(currency)
-                name = currencies.get(currency, "")
-                response += f"{emoji} *{currency}* - {name}\n"
-            
-            # Add other currencies
-            response += "\n*Other Currencies:*\n"
-            for currency, name in currencies.items():
-                if currency not in POPULAR_CURRENCIES:
+                # Add popular currencies first
+                response += "*Popular Currencies:*\n"
+                for currency in tenant.popular_currencies:
                     emoji = get_currency_emoji(currency)
+                    name = currencies.get(currency, "")
                     response += f"{emoji} *{currency}* - {name}\n"
             
-            update.message.reply_markdown_v2(response)
+                # Add other currencies
+                response += "\n*Other Currencies:*\n"
+                for currency, name in currencies.items():
+                    if currency not in tenant.popular_currencies:
+                        emoji = get_currency_emoji(currency)
+                        response += f"{emoji} *{currency}* - {name}\n"
+            
+            reply.send_markdown(response)
         else:
-            update.message.reply_text(
+            reply.send(
                 "Sorry, I couldn't get the list of supported currencies. "
                 "Please try again later."
             )
     except Exception as e:
-        logger.error(f"Error in currencies_command: {e}")
-        update.message.reply_text(
+        logger.error("Error in currencies_command: %s", e)
+        reply.send(
             "Sorry, there was an error getting the currency list. "
             "Please try again later."
         )
 
 def compare_command(update: Update, context: CallbackContext) -> None:
     """Compare a base currency to target currencies."""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # Track analytics
-    analytics.track_user(user.id, username=user.username, first_name=user.first_name)
-    analytics.track_command('compare', user.id)
+    tenant.analytics.track_user(user.id, username=user.username, first_name=user.first_name)
+    tenant.analytics.track_command('compare', user.id)
     
     # Check if arguments were provided
     if not context.args or len(context.args) < 2:
-        update.message.reply_text(
+        reply_text(
+            update,
             "Please provide a base currency and at least one target currency to compare.\n"
             "Example: /compare USD EUR GBP JPY"
         )
@@ -706,220 +3920,282 @@ def compare_command(update: Update, context: CallbackContext) -> None:
     base_currency = context.args[0].upper()
     target_currencies = [currency.upper() for currency in context.args[1:]]
     
-    update.message.reply_text(
-        f"Comparing {base_currency} to {', '.join(target_currencies)}..."
-    )
+    reply = PendingReply(update)
+    if not rate_cache.contains(base_currency):
+        reply.show_placeholder(f"Comparing {base_currency} to {', '.join(target_currencies)}...")
     
     try:
         # Get the comparison
         comparison = get_currency_comparison(base_currency, target_currencies)
         
         if comparison:
-            # Create the response message
-            response = (
-                f"{EMOJI['chart']} *Currency Comparison*\n\n"
-                f"Base currency: {get_currency_emoji(base_currency)} *{base_currency}*\n\n"
-            )
+            with trace_span("build"):
+                # Create the response message
+                response = (
+                    f"{EMOJI['chart']} *Currency Comparison*\n\n"
+                    f"Base currency: {get_currency_emoji(base_currency)} *{base_currency}*\n\n"
+                )
             
-            for currency, rate in comparison.items():
-                emoji = get_currency_emoji(currency)
-                response += f"{emoji} *{currency}*: {rate:.4f}\n"
+                for currency, rate in comparison.items():
+                    emoji = get_currency_emoji(currency)
+                    response += f"{emoji} *{currency}*: {rate:.4f}\n"
             
-            # Add Wise referral button
-            keyboard = [
-                [InlineKeyboardButton(
-                    f"{EMOJI['rocket']} Convert {base_currency} with best rate", 
-                    url=WISE_REFERRAL_LINK
-                )]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+                # Add Wise referral button
+                reply_markup = wise_keyboard(base_currency, tenant.wise_referral_link)
             
-            update.message.reply_markdown_v2(response, reply_markup=reply_markup)
+            reply.send_markdown(response, reply_markup=reply_markup)
         else:
-            update.message.reply_text(
+            reply.send(
                 f"Sorry, I couldn't compare {base_currency} to the target currencies. "
                 "Please check the currency codes and try again."
             )
     except Exception as e:
-        logger.error(f"Error in compare_command: {e}")
-        update.message.reply_text(
+        logger.error("Error in compare_command: %s", e)
+        reply.send(
             "Sorry, there was an error comparing the currencies. "
             "Please try again later."
         )
 
+# Shown with every currency picker
+CURRENCY_PICKER_HINT = "Tap a currency, or type a code or name to search (e.g. yen, franc)."
+
 def convert_command(update: Update, context: CallbackContext) -> int:
     """Start the conversion process by asking for the base currency."""
+    tenant = get_tenant(context)
     user = update.effective_user
     
     # Track analytics
-    analytics.track_user(user.id, username=user.username, first_name=user.first_name)
-    analytics.track_command('convert', user.id)
+    tenant.analytics.track_user(user.id, username=user.username, first_name=user.first_name)
+    tenant.analytics.track_command('convert', user.id)
     
     # Reset user's conversion state
-    user_conversion_state[update.effective_user.id] = {}
+    tenant.conversations.start(update.effective_user.id)
     
     # Get supported currencies
     currencies = get_supported_currencies()
     
     if not currencies:
-        update.message.reply_text(
+        reply_text(
+            update,
             "Sorry, I couldn't get the list of supported currencies. "
             "Please try again later."
         )
         return ConversationHandler.END
     
-    # Create inline keyboard with popular currencies
-    keyboard = []
-    row = []
-    for i, currency in enumerate(POPULAR_CURRENCIES):
-        emoji = get_currency_emoji(currency)
-        row.append(InlineKeyboardButton(f"{emoji} {currency}", callback_data=currency))
-        if (i + 1) % 3 == 0 or i == len(POPULAR_CURRENCIES) - 1:
-            keyboard.append(row)
-            row = []
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    update.message.reply_text(
-        f"Please select the base currency (from):",
-        reply_markup=reply_markup
+    refresh_currency_catalog(currencies)
+    
+    reply_text(
+        update,
+        f"Please select the base currency (from):\n{CURRENCY_PICKER_HINT}",
+        reply_markup=get_keyboard("popular", tenant)
     )
     
     return SELECTING_BASE
 
+def select_base_currency(update, tenant, state, currency, edit=True):
+    """Store the base currency and ask for the target currency."""
+    state.base_currency = currency
+    tenant.conversations.save(update.effective_user.id, state)
+    
+    send = edit_message_text if edit else reply_text
+    send(
+        update,
+        f"Base currency: {get_currency_emoji(currency)} {currency}\n\n"
+        f"Now, please select the target currency (to):\n{CURRENCY_PICKER_HINT}",
+        reply_markup=get_keyboard("popular", tenant)
+    )
+    
+    return SELECTING_TARGET
+
+def select_target_currency(update, tenant, state, currency, edit=True):
+    """Store the target currency and ask for the amount."""
+    state.target_currency = currency
+    tenant.conversations.save(update.effective_user.id, state)
+    
+    base_currency = state.base_currency
+    
+    send = edit_message_text if edit else reply_text
+    send(
+        update,
+        f"Base currency: {get_currency_emoji(base_currency)} {base_currency}\n"
+        f"Target currency: {get_currency_emoji(currency)} {currency}\n\n"
+        f"Please enter the amount to convert:"
+    )
+    
+    return ENTERING_AMOUNT
+
 def handle_base_selection(update: Update, context: CallbackContext) -> int:
     """Handle the selection of the base currency."""
+    tenant = get_tenant(context)
     query = update.callback_query
     query.answer()
     
-    user_id = update.effective_user.id
-    user_conversion_state[user_id]['base_currency'] = query.data
-    
-    # Get supported currencies
-    currencies = get_supported_currencies()
-    
-    # Create inline keyboard with popular currencies
-    keyboard = []
-    row = []
-    for i, currency in enumerate(POPULAR_CURRENCIES):
-        emoji = get_currency_emoji(currency)
-        row.append(InlineKeyboardButton(f"{emoji} {currency}", callback_data=currency))
-        if (i + 1) % 3 == 0 or i == len(POPULAR_CURRENCIES) - 1:
-            keyboard.append(row)
-            row = []
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    query.edit_message_text(
-        f"Base currency: {get_currency_emoji(query.data)} {query.data}\n\n"
-        f"Now, please select the target currency (to):",
-        reply_markup=reply_markup
-    )
+    state = tenant.conversations.get(update.effective_user.id)
+    if state is None:
+        return conversation_expired(update, context)
     
-    return SELECTING_TARGET
+    return select_base_currency(update, tenant, state, query.data)
 
 def handle_target_selection(update: Update, context: CallbackContext) -> int:
     """Handle the selection of the target currency."""
+    tenant = get_tenant(context)
     query = update.callback_query
     query.answer()
     
-    user_id = update.effective_user.id
-    user_conversion_state[user_id]['target_currency'] = query.data
+    state = tenant.conversations.get(update.effective_user.id)
+    if state is None:
+        return conversation_expired(update, context)
     
-    base_currency = user_conversion_state[user_id]['base_currency']
+    return select_target_currency(update, tenant, state, query.data)
+
+def handle_currency_page(update: Update, context: CallbackContext) -> None:
+    """Switch the picker between the popular currencies and pages of the full list."""
+    query = update.callback_query
+    query.answer()
     
-    query.edit_message_text(
-        f"Base currency: {get_currency_emoji(base_currency)} {base_currency}\n"
-        f"Target currency: {get_currency_emoji(query.data)} {query.data}\n\n"
-        f"Please enter the amount to convert:"
-    )
+    page = query.data.split(":", 1)[1]
+    name = "popular" if page == "popular" else f"page:{page}"
+    reply_markup = get_keyboard(name, get_tenant(context))
+    if reply_markup is not None:
+        edit_message_reply_markup(update, reply_markup)
     
-    return ENTERING_AMOUNT
+    # Returning None keeps the conversation in its current state
+    return None
+
+def handle_currency_search(update: Update, context: CallbackContext) -> int:
+    """Filter currencies by a typed code or name.
+
+    A single match (or an exact code) is taken as the selection right away;
+    otherwise the matches are offered as buttons.
+    """
+    tenant = get_tenant(context)
+    state = tenant.conversations.get(update.effective_user.id)
+    if state is None:
+        return conversation_expired(update, context)
+    
+    selecting_base = state.base_currency is None
+    matches = currency_index.search(update.message.text)
+    exact = update.message.text.strip().upper()
+    
+    if matches and (len(matches) == 1 or matches[0] == exact):
+        if selecting_base:
+            return select_base_currency(update, tenant, state, matches[0], edit=False)
+        return select_target_currency(update, tenant, state, matches[0], edit=False)
+    
+    if not matches:
+        reply_text(
+            update,
+            "No currency matches that. Try a code like EUR or a name like peso.",
+            reply_markup=get_keyboard("popular", tenant)
+        )
+    else:
+        reply_text(
+            update,
+            f"Currencies matching \"{update.message.text.strip()}\":",
+            reply_markup=search_keyboard(tuple(matches))
+        )
+    
+    return SELECTING_BASE if selecting_base else SELECTING_TARGET
 
 def handle_amount_entry(update: Update, context: CallbackContext) -> int:
     """Handle the entry of the amount to convert."""
+    tenant = get_tenant(context)
     user_id = update.effective_user.id
+    state = tenant.conversations.get(user_id)
+    if state is None:
+        return conversation_expired(update, context)
     
+    reply = PendingReply(update)
     try:
         # Parse the amount
         amount = float(update.message.text.strip())
         
         # Get the conversion currencies
-        base_currency = user_conversion_state[user_id]['base_currency']
-        target_currency = user_conversion_state[user_id]['target_currency']
+        base_currency = state.base_currency
+        target_currency = state.target_currency
         
         # Track conversion in analytics
-        analytics.track_conversion(base_currency, target_currency, amount, user_id)
+        tenant.analytics.track_conversion(base_currency, target_currency, amount, user_id)
         
-        update.message.reply_text(f"Converting {amount} {base_currency} to {target_currency}...")
+        if base_currency != target_currency and not rate_cache.contains(base_currency):
+            reply.show_placeholder(f"Converting {amount} {base_currency} to {target_currency}...")
         
         # Perform the conversion
         result = convert_currency(amount, base_currency, target_currency)
         
         if result is not None:
-            # Create the response message
-            response = (
-                f"{EMOJI['exchange']} *Currency Conversion*\n\n"
-                f"{amount:.2f} {get_currency_emoji(base_currency)} *{base_currency}* = "
-                f"{result:.2f} {get_currency_emoji(target_currency)} *{target_currency}*\n\n"
-                f"Exchange rate: 1 {base_currency} = {result/amount:.4f} {target_currency}"
-            )
+            with trace_span("build"):
+                # Create the response message
+                response = (
+                    f"{EMOJI['exchange']} *Currency Conversion*\n\n"
+                    f"{amount:.2f} {get_currency_emoji(base_currency)} *{base_currency}* = "
+                    f"{result:.2f} {get_currency_emoji(target_currency)} *{target_currency}*\n\n"
+                    f"Exchange rate: 1 {base_currency} = {result/amount:.4f} {target_currency}"
+                )
             
-            # Add Wise referral button
-            keyboard = [
-                [InlineKeyboardButton(
-                    f"{EMOJI['rocket']} Convert with best rate", 
-                    url=WISE_REFERRAL_LINK
-                )]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+                # Add Wise referral button
+                reply_markup = get_keyboard("wise", tenant)
             
-            update.message.reply_markdown_v2(response, reply_markup=reply_markup)
+            reply.send_markdown(response, reply_markup=reply_markup)
         else:
-            update.message.reply_text(
+            reply.send(
                 f"Sorry, I couldn't convert {base_currency} to {target_currency}. "
                 "Please check the currency codes and try again."
             )
     except ValueError:
-        update.message.reply_text(
+        reply.send(
             "Please enter a valid number for the amount."
         )
         return ENTERING_AMOUNT
     except Exception as e:
-        logger.error(f"Error in handle_amount_entry: {e}")
-        update.message.reply_text(
+        logger.error("Error in handle_amount_entry: %s", e)
+        reply.send(
             "Sorry, there was an error converting the currencies. "
             "Please try again later."
         )
     
     # Clear the user's conversion state
-    if user_id in user_conversion_state:
-        del user_conversion_state[user_id]
+    tenant.conversations.discard(user_id)
     
     return ConversationHandler.END
 
 def cancel(update: Update, context: CallbackContext) -> int:
     """Cancel the conversation."""
-    update.message.reply_text(
+    tenant = get_tenant(context)
+    reply_text(
+        update,
         "Conversion cancelled. If you need anything else, just ask!"
     )
     
     # Clear the user's conversion state
-    user_id = update.effective_user.id
-    if user_id in user_conversion_state:
-        del user_conversion_state[user_id]
+    tenant.conversations.discard(update.effective_user.id)
     
     return ConversationHandler.END
 
+def conversation_expired(update: Update, context: CallbackContext) -> int:
+    """Tell the user their wizard expired and end the conversation."""
+    message = "This conversion has expired. Use /convert to start again."
+    if update.callback_query:
+        edit_message_text(update, message)
+    else:
+        reply_text(update, message)
+    return ConversationHandler.END
+
+def conversation_timeout(update: Update, context: CallbackContext) -> None:
+    """Drop the wizard state when ConversationHandler times the conversation out."""
+    if update and update.effective_user:
+        get_tenant(context).conversations.discard(update.effective_user.id)
+
 def handle_unknown(update: Update, context: CallbackContext) -> None:
     """Handle unknown commands or messages.
     Tries to parse natural language conversion requests like '100 USD to EUR'
     """
+    tenant = get_tenant(context)
     message_text = update.message.text.strip()
     user = update.effective_user
     
     # Track user
-    analytics.track_user(user.id, username=user.username, first_name=user.first_name)
+    tenant.analytics.track_user(user.id, username=user.username, first_name=user.first_name)
     
     # Try to match natural language conversion patterns
     # Pattern 1: "100 USD to EUR" or "100 USD in EUR"
@@ -942,10 +4218,10 @@ def handle_unknown(update: Update, context: CallbackContext) -> None:
             amount = float(amount_str)
             
             # Track command
-            analytics.track_command('natural_conversion', user.id)
+            tenant.analytics.track_command('natural_conversion', user.id)
             
             # Process the conversion
-            process_natural_conversion(update, amount, from_currency, to_currency)
+            process_natural_conversion(update, amount, from_currency, to_currency, tenant)
             
             return
         except ValueError:
@@ -963,17 +4239,18 @@ def handle_unknown(update: Update, context: CallbackContext) -> None:
             amount = float(amount_str)
             
             # Track command
-            analytics.track_command('natural_conversion', user.id)
+            tenant.analytics.track_command('natural_conversion', user.id)
             
             # Process the conversion
-            process_natural_conversion(update, amount, from_currency, to_currency)
+            process_natural_conversion(update, amount, from_currency, to_currency, tenant)
             
             return
         except ValueError:
             pass
     
     # If no pattern matched, reply with help
-    update.message.reply_text(
+    reply_text(
+        update,
         "I'm not sure what you mean. Here are some examples of what you can ask:\n\n"
         "• 100 USD to EUR\n"
         "• 50 USDT in BDT\n"
@@ -981,97 +4258,159 @@ def handle_unknown(update: Update, context: CallbackContext) -> None:
         "Or use /help to see all available commands."
     )
 
-def process_natural_conversion(update, amount, from_currency, to_currency):
+def process_natural_conversion(update, amount, from_currency, to_currency, tenant=None):
     """Process currency conversion from natural language input."""
+    tenant = tenant or default_tenant
     
     # Track conversion in analytics
-    analytics.track_conversion(from_currency, to_currency, amount, update.effective_user.id)
+    tenant.analytics.track_conversion(from_currency, to_currency, amount, update.effective_user.id)
     
-    update.message.reply_text(f"Converting {amount} {from_currency} to {to_currency}...")
+    reply = PendingReply(update)
+    if from_currency != to_currency and not rate_cache.contains(from_currency):
+        reply.show_placeholder(f"Converting {amount} {from_currency} to {to_currency}...")
     
     try:
         # Perform the conversion
         result = convert_currency(amount, from_currency, to_currency)
         
         if result is not None:
-            # Create the response message
-            response = (
-                f"{EMOJI['exchange']} *Currency Conversion*\n\n"
-                f"{amount:.2f} {get_currency_emoji(from_currency)} *{from_currency}* = "
-                f"{result:.2f} {get_currency_emoji(to_currency)} *{to_currency}*\n\n"
-                f"Exchange rate: 1 {from_currency} = {result/amount:.4f} {to_currency}"
-            )
+            with trace_span("build"):
+                # Create the response message
+                response = (
+                    f"{EMOJI['exchange']} *Currency Conversion*\n\n"
+                    f"{amount:.2f} {get_currency_emoji(from_currency)} *{from_currency}* = "
+                    f"{result:.2f} {get_currency_emoji(to_currency)} *{to_currency}*\n\n"
+                    f"Exchange rate: 1 {from_currency} = {result/amount:.4f} {to_currency}"
+                )
             
-            # Add Wise referral button
-            keyboard = [
-                [InlineKeyboardButton(
-                    f"{EMOJI['rocket']} Convert with best rate", 
-                    url=WISE_REFERRAL_LINK
-                )]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+                # Add Wise referral button
+                reply_markup = get_keyboard("wise", tenant)
             
-            update.message.reply_markdown_v2(response, reply_markup=reply_markup)
+            reply.send_markdown(response, reply_markup=reply_markup)
         else:
-            update.message.reply_text(
+            reply.send(
                 f"Sorry, I couldn't convert {from_currency} to {to_currency}. "
                 "Please check the currency codes and try again."
             )
     except Exception as e:
-        logger.error(f"Error in process_natural_conversion: {e}")
-        update.message.reply_text(
+        logger.error("Error in process_natural_conversion: %s", e)
+        reply.send(
             "Sorry, there was an error converting the currencies. "
             "Please try again later."
         )
 
+def register_handlers(dispatcher):
+    """Register the bot's handlers on a dispatcher."""
+    # Create the conversation handler for currency conversion
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('convert', instrument_handler(convert_command))],
+        states={
+            SELECTING_BASE: [
+                CallbackQueryHandler(instrument_handler(handle_currency_page), pattern=r"^page:"),
+                CallbackQueryHandler(instrument_handler(handle_base_selection)),
+                MessageHandler(Filters.text & ~Filters.command, instrument_handler(handle_currency_search)),
+            ],
+            SELECTING_TARGET: [
+                CallbackQueryHandler(instrument_handler(handle_currency_page), pattern=r"^page:"),
+                CallbackQueryHandler(instrument_handler(handle_target_selection)),
+                MessageHandler(Filters.text & ~Filters.command, instrument_handler(handle_currency_search)),
+            ],
+            ENTERING_AMOUNT: [MessageHandler(Filters.text & ~Filters.command,
+                                             instrument_handler(handle_amount_entry))],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)]
+        },
+        fallbacks=[CommandHandler('cancel', instrument_handler(cancel))],
+        # Abandoned wizards are ended by the job queue; the state store
+        # uses the same TTL so both forget the session together
+        conversation_timeout=CONVERSATION_TIMEOUT
+    )
+    
+    # Note each update's arrival for /readyz, then shed floods
+    dispatcher.add_handler(TypeHandler(
+        Update, lambda update, context: health.note_update(update, get_tenant(context).name)), group=-2)
+    dispatcher.add_handler(TypeHandler(Update, rate_limit_updates), group=-1)
+    
+    # Register handlers
+    dispatcher.add_handler(CommandHandler('start', instrument_handler(start)))
+    dispatcher.add_handler(CommandHandler('help', instrument_handler(help_command)))
+    dispatcher.add_handler(CommandHandler('rates', instrument_handler(rates_command)))
+    dispatcher.add_handler(CommandHandler('currencies', instrument_handler(currencies_command)))
+    dispatcher.add_handler(CommandHandler('compare', instrument_handler(compare_command)))
+    dispatcher.add_handler(conv_handler)
+    
+    # Add handler for unknown messages or commands
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command,
+                                          instrument_handler(handle_unknown)))
+    
+    # Log errors
+    def error_handler(update, context):
+        """Log Errors caused by Updates."""
+        logger.error("Update %s caused error %s", update, context.error)
+    
+    dispatcher.add_error_handler(error_handler)
+
+class MultiUpdater:
+    """Runs the Updaters of several bots as one application."""
+
+    def __init__(self, updaters):
+        self.updaters = updaters
+
+    def start_polling(self):
+        for updater in self.updaters:
+            updater.start_polling()
+
+    def idle(self):
+        """Block until a stop signal, then stop every bot."""
+        self.updaters[0].idle()
+        for updater in self.updaters[1:]:
+            updater.stop()
+
 def create_application():
-    """Create and configure the bot application."""
+    """Create and configure the bot application.
+
+    One Updater and dispatcher is created per bot (see BOTS_CONFIG); with
+    several bots they are returned together as a MultiUpdater.
+    """
     
+    setup_logging()
     logger.info("Starting CurrenzBot")
     
-    # Check if the bot token is available
-    if not TELEGRAM_TOKEN:
+    # Watch memory usage so caches can be trimmed before the host kills us
+    memory_monitor.start()
+    
+    load_telegram()
+    
+    try:
+        configured = load_tenants()
+    except Exception as e:
+        logger.error("Error loading bot configs from %s: %s", BOTS_CONFIG, e)
+        return None
+    
+    # Check if the bot tokens are available
+    if not configured or not all(tenant.token for tenant in configured):
         logger.error("No Telegram token provided!")
         return None
     
     try:
-        # Create the Updater and pass it the bot's token
-        updater = Updater(TELEGRAM_TOKEN)
-        
-        # Get the dispatcher to register handlers
-        dispatcher = updater.dispatcher
-        
-        # Create the conversation handler for currency conversion
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('convert', convert_command)],
-            states={
-                SELECTING_BASE: [CallbackQueryHandler(handle_base_selection)],
-                SELECTING_TARGET: [CallbackQueryHandler(handle_target_selection)],
-                ENTERING_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, handle_amount_entry)]
-            },
-            fallbacks=[CommandHandler('cancel', cancel)]
-        )
-        
-        # Register handlers
-        dispatcher.add_handler(CommandHandler('start', start))
-        dispatcher.add_handler(CommandHandler('help', help_command))
-        dispatcher.add_handler(CommandHandler('rates', rates_command))
-        dispatcher.add_handler(CommandHandler('currencies', currencies_command))
-        dispatcher.add_handler(CommandHandler('compare', compare_command))
-        dispatcher.add_handler(conv_handler)
-        
-        # Add handler for unknown messages or commands
-        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_unknown))
-        
-        # Log errors
-        def error_handler(update, context):
-            """Log Errors caused by Updates."""
-            logger.error(f"Update {update} caused error {context.error}")
+        updaters = []
+        for tenant in configured:
+            # Create the Updater and pass it the bot's token
+            updater = Updater(tenant.token)
+            
+            # Get the dispatcher to register handlers
+            dispatcher = updater.dispatcher
+            dispatcher.bot_data["tenant"] = tenant
+            register_handlers(dispatcher)
+            
+            tenants[tenant.name] = tenant
+            active_dispatchers.append(dispatcher)
+            updaters.append(updater)
         
-        dispatcher.add_error_handler(error_handler)
+        # Build the inline keyboards once, before the first update arrives
+        build_keyboards()
         
         # Start the bot
-        logger.info("Starting bot polling")
+        logger.info("Starting bot polling for %d bot(s)", len(updaters))
         
         # For testing purposes, we can return a mock updater for non-polling
         if os.environ.get("TESTING") == "1":
@@ -1080,24 +4419,132 @@ def create_application():
                 def idle(self): pass
             return MockUpdater()
         
-        return updater
+        for tenant, updater in zip(configured, updaters):
+            health.watch(tenant.name, updater)
+        
+        return updaters[0] if len(updaters) == 1 else MultiUpdater(updaters)
     
     except Exception as e:
-        logger.error(f"Error creating application: {e}")
+        logger.error("Error creating application: %s", e)
         return None
 
+# --- CONFIG RELOAD MODULE ---
+# Settings from CONFIG_FILE replace the module-level defaults. A reload
+# swaps in new values and rebuilds only what depends on the changed ones;
+# handlers already running keep the values they started with, and the rate
+# cache, analytics and wizard state are left alone.
+_config_lock = threading.Lock()
+
+def _currency_code_list(value):
+    # An empty list would leave the popular picker without buttons
+    if not isinstance(value, list) or not value or not all(isinstance(c, str) for c in value):
+        raise ValueError("popular_currencies must be a non-empty list of currency codes")
+    return [c.upper() for c in value]
+
+def _string_map(value, setting):
+    if not isinstance(value, dict) or not all(isinstance(v, str) for v in value.values()):
+        raise ValueError(f"{setting} must map currency codes to strings")
+    return {k.upper(): v for k, v in value.items()}
+
+def _non_negative_int(value, setting):
+    # bool is a subclass of int, but true/false is not a TTL
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(f"{setting} must be a non-negative integer")
+    return value
+
+def _http_url(value, setting):
+    if not isinstance(value, str) or not re.match(r"https?://\S+$", value.strip()):
+        raise ValueError(f"{setting} must be an http(s) URL")
+    return value.strip()
+
+# Setting name in the file -> (module global, validator)
+CONFIG_SETTINGS = {
+    "popular_currencies": ("POPULAR_CURRENCIES", _currency_code_list),
+    "currency_symbols": ("CURRENCY_SYMBOLS", lambda v: _string_map(v, "currency_symbols")),
+    "currency_names": ("CURRENCY_NAMES", lambda v: _string_map(v, "currency_names")),
+    "wise_referral_link": ("WISE_REFERRAL_LINK", lambda v: _http_url(v, "wise_referral_link")),
+    "rates_cache_ttl": ("RATES_CACHE_TTL", lambda v: _non_negative_int(v, "rates_cache_ttl")),
+}
+
+def read_config_file(path=None):
+    """Read and validate the config file; unknown keys are an error."""
+    with open(path or CONFIG_FILE, 'r') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError("the config file must contain a JSON object")
+    unknown = set(config) - set(CONFIG_SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown settings: {', '.join(sorted(unknown))}")
+    return {name: CONFIG_SETTINGS[name][1](value) for name, value in config.items()}
+
+def reload_config(path=None):
+    """Apply the config file and return the names of the settings that changed.
+
+    Nothing is applied if any setting is invalid.
+    """
+    config = read_config_file(path)
+    with _config_lock:
+        module = globals()
+        changed = [name for name, value in config.items() if module[CONFIG_SETTINGS[name][0]] != value]
+        previous_names = CURRENCY_NAMES
+        for name in changed:
+            module[CONFIG_SETTINGS[name][0]] = config[name]
+        
+        if "rates_cache_ttl" in changed:
+            # Entries already cached keep the expiry they were stored with
+            rate_cache.ttl = RATES_CACHE_TTL
+        if "currency_names" in changed:
+            added = [code for code, name in CURRENCY_NAMES.items()
+                     if previous_names.get(code) != name and currency_index.add(code, name)]
+            if added and _keyboards:
+                build_keyboards()
+        if "popular_currencies" in changed:
+            # Drop renderings for popular lists no bot uses any more
+            in_use = {tuple(t.popular_currencies) for t in {default_tenant, *tenants.values()}}
+            for key in [k for k in list(_rendered_rates) if k[1] not in in_use]:
+                _rendered_rates.pop(key, None)
+        if {"popular_currencies", "wise_referral_link"} & set(changed) and _keyboards:
+            # Keyboards not built yet will pick up the new values when they are
+            build_keyboards()
+    
+    if changed:
+        logger.info("Reloaded %s: changed %s", CONFIG_FILE, ", ".join(changed))
+    return changed
+
+def reload_config_in_background(signum=None, frame=None):
+    """SIGHUP handler: reload the config outside of the signal handler."""
+    def run():
+        try:
+            reload_config()
+        except Exception as e:
+            logger.error("Error reloading %s: %s", CONFIG_FILE, e)
+    threading.Thread(target=run, name="config-reload", daemon=True).start()
+
+if os.path.exists(CONFIG_FILE):
+    try:
+        reload_config()
+    except Exception as e:
+        logger.error("Error loading %s, using the built-in settings: %s", CONFIG_FILE, e)
+
 # --- MAIN FUNCTION ---
 def main():
     """Start the bot and the keep-alive server."""
+    setup_logging()
+    
     # Start the keep-alive web server to prevent the bot from sleeping
     start_keep_alive()
     
+    # `kill -HUP <pid>` re-reads CONFIG_FILE
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_config_in_background)
+    
     # Create and start the bot
     application = create_application()
     
     if application:
         # Start the bot
         application.start_polling()
+        mark_ready("bot")
         
         # Run the bot until the user presses Ctrl-C
         application.idle()
@@ -1107,6 +4554,7 @@ def main():
 # For Gunicorn to use in Render deployment
 # The Flask app must be available at module level
 # This ensures the Flask app can run without the bot if needed
+mark_ready("web")
 
 # For standalone execution, run the full bot
 if __name__ == "__main__":
@@ -0,0 +1,11 @@
+"""Shared setup: import the bot from the repo root with data files in a temp dir."""
+import os
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("TESTING", "1")
+
+# Analytics and quota files are written relative to the working directory
+os.chdir(tempfile.mkdtemp(prefix="currenzbot-tests-"))
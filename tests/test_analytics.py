@@ -0,0 +1,71 @@
+"""The analytics event log."""
+import os
+
+import currenzbot_full as bot_module
+
+def test_event_log_file_is_created_by_the_first_event(tmp_path):
+    path = str(tmp_path / "events.ndjson")
+    log = bot_module.AnalyticsEventLog(path)
+    log.backfill([{"date": "2024-01-02", "from": "USD", "to": "EUR", "amount": 5}])
+    assert not os.path.exists(path)
+
+    log.append("command", command="start")
+    events = list(log.iter_events())
+    assert [e["type"] for e in events] == ["conversion", "command"]
+    assert events[0]["time"] == "2024-01-02T00:00:00"
+
+def test_existing_log_is_not_backfilled_again(tmp_path):
+    path = str(tmp_path / "events.ndjson")
+    bot_module.AnalyticsEventLog(path).append("command", command="start")
+
+    log = bot_module.AnalyticsEventLog(path)
+    log.backfill([{"date": "2024-01-02", "from": "USD", "to": "EUR", "amount": 5}])
+    log.append("command", command="help")
+    assert [e.get("command") for e in log.iter_events()] == ["start", "help"]
+
+def test_event_log_rotates_by_size_and_exports_every_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, "ANALYTICS_EVENTS_CHECK_INTERVAL", 0)
+    path = str(tmp_path / "events.ndjson")
+    log = bot_module.AnalyticsEventLog(path, max_bytes=200, backups=2)
+    for i in range(30):
+        log.append("user", user_id=str(i))
+
+    assert os.path.getsize(path) < 300
+    assert os.path.exists(f"{path}.2")
+    assert not os.path.exists(f"{path}.3")
+    ids = [int(e["user_id"]) for e in log.iter_events()]
+    # The oldest events went with the dropped file; the rest are in order
+    assert ids == list(range(ids[0], 30))
+
+def test_writer_follows_a_rotation_by_another_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, "ANALYTICS_EVENTS_CHECK_INTERVAL", 0)
+    path = str(tmp_path / "events.ndjson")
+    first = bot_module.AnalyticsEventLog(path, max_bytes=0)
+    second = bot_module.AnalyticsEventLog(path, max_bytes=0)
+    first.append("command", command="a")
+    second.append("command", command="b")
+
+    os.replace(path, f"{path}.1")
+    second.append("command", command="c")
+    with open(path) as f:
+        assert [line for line in f if '"c"' in line]
+    assert [e["command"] for e in first.iter_events()] == ["a", "b", "c"]
+
+def test_activity_bitsets_are_ints_in_memory_and_hex_in_storage(tmp_path):
+    backend = bot_module.SQLiteBackend(str(tmp_path / "state.db"))
+    analytics = bot_module.BotAnalytics(backend=backend, name="bits")
+    for user_id in (1, 2, 3):
+        analytics.track_user(user_id)
+    month = next(iter(analytics.data["activity"]["months"]))
+
+    assert analytics.data["activity"]["months"][month] == 0b111
+    assert backend.get(analytics.namespace, f"activity:months:{month}") == "7"
+    _, version = backend.changes(analytics.namespace)
+
+    # Later interactions the same day leave the bitset rows alone
+    analytics.track_user(2)
+    rows, _ = backend.changes(analytics.namespace, version)
+    assert [key for key, _ in rows] == ["user:2"]
+
+    reloaded = bot_module.BotAnalytics(backend=backend, name="bits")
+    assert reloaded.get_monthly_users(month)["count"] == 3
@@ -0,0 +1,42 @@
+"""Config reload through /admin/reload-config."""
+import json
+
+import pytest
+
+import currenzbot_full as bot_module
+
+@pytest.fixture
+def reload_with(tmp_path, monkeypatch):
+    path = tmp_path / "config.json"
+    monkeypatch.setattr(bot_module, "CONFIG_FILE", str(path))
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    # Keep the request hook from setting up logging for the whole test run
+    monkeypatch.setattr(bot_module, "setup_logging", lambda: None)
+    client = bot_module.app.test_client()
+
+    def post(config):
+        path.write_text(json.dumps(config))
+        return client.post("/admin/reload-config", headers={"X-Admin-Token": "secret"})
+
+    return post
+
+@pytest.mark.parametrize("config, message", [
+    ({"popular_currencies": []}, "non-empty list"),
+    ({"popular_currencies": ["USD", 1]}, "list of currency codes"),
+    ({"rates_cache_ttl": True}, "non-negative integer"),
+    ({"wise_referral_link": "not a url"}, "http(s) URL"),
+    ({"unknown_setting": 1}, "unknown settings"),
+])
+def test_invalid_config_is_rejected_and_not_applied(reload_with, config, message):
+    before = list(bot_module.POPULAR_CURRENCIES)
+    response = reload_with(config)
+    assert response.status_code == 400
+    assert message in response.get_json()["error"]
+    assert bot_module.POPULAR_CURRENCIES == before
+
+def test_valid_config_is_applied(reload_with, monkeypatch):
+    monkeypatch.setattr(bot_module, "POPULAR_CURRENCIES", list(bot_module.POPULAR_CURRENCIES))
+    response = reload_with({"popular_currencies": ["usd", "eur"]})
+    assert response.status_code == 200
+    assert response.get_json()["changed"] == ["popular_currencies"]
+    assert bot_module.POPULAR_CURRENCIES == ["USD", "EUR"]
@@ -0,0 +1,34 @@
+"""The polling watchdog."""
+import time
+from types import SimpleNamespace
+
+import currenzbot_full as bot_module
+
+def fake_updater():
+    return SimpleNamespace(running=True, bot=SimpleNamespace(get_updates=lambda *a, **k: []))
+
+def test_a_busy_bot_does_not_hide_a_hung_one():
+    monitor = bot_module.HealthMonitor(interval=0.05, stall_intervals=2)
+    busy, hung = fake_updater(), fake_updater()
+    monitor.watch("busy", busy)
+    monitor.watch("hung", hung)
+
+    # getUpdates never returns for either bot, but "busy" keeps getting updates
+    deadline = time.monotonic() + 0.3
+    while time.monotonic() < deadline:
+        monitor.note_update(None, "busy")
+        time.sleep(0.01)
+
+    assert not monitor._stalled("busy", busy)
+    assert monitor._stalled("hung", hung)
+    assert monitor.report()["polling"] == {"busy": True, "hung": False}
+
+def test_polling_counts_as_progress():
+    monitor = bot_module.HealthMonitor(interval=0.05, stall_intervals=2)
+    updater = fake_updater()
+    monitor.watch("bot", updater)
+    time.sleep(0.15)
+    assert monitor._stalled("bot", updater)
+
+    updater.bot.get_updates()
+    assert not monitor._stalled("bot", updater)
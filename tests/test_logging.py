@@ -0,0 +1,34 @@
+"""Logging is configured by the entry points, not on import."""
+import atexit
+import logging
+import os
+import subprocess
+import sys
+
+import currenzbot_full as bot_module
+
+def test_import_leaves_the_root_handlers_alone():
+    # A fresh interpreter, as other tests may already have set logging up
+    code = ("import logging, currenzbot_full as m; "
+            "assert m.log_handler not in logging.getLogger().handlers; "
+            "assert m.log_listener is None")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+def test_setup_adds_the_queue_handler_once(monkeypatch):
+    root = logging.getLogger()
+    existing = logging.NullHandler()
+    root.addHandler(existing)
+    monkeypatch.setattr(root, "level", root.level)
+    try:
+        listener = bot_module.setup_logging()
+        assert bot_module.setup_logging() is listener
+        assert existing in root.handlers
+        assert root.handlers.count(bot_module.log_handler) == 1
+    finally:
+        root.removeHandler(existing)
+        root.removeHandler(bot_module.log_handler)
+        if bot_module.log_listener is not None:
+            atexit.unregister(bot_module.log_listener.stop)
+            bot_module.log_listener.stop()
+            bot_module.log_listener = None
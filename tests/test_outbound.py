@@ -0,0 +1,152 @@
+"""Outbound scheduler against a fake bot that enforces Telegram's limits."""
+import threading
+import time
+from concurrent.futures import wait
+
+import pytest
+
+import currenzbot_full as bot_module
+from benchmark import FakeBot, FakeRetryAfter, make_update
+
+@pytest.fixture(scope="module", autouse=True)
+def telegram():
+    bot_module.load_telegram()
+
+def test_global_rate_is_respected():
+    bot = FakeBot(enforce_limits=True, global_rate=25, chat_interval=0)
+    scheduler = bot_module.OutboundScheduler(global_rate=10, chat_rate=1000, chat_burst=1000)
+    started = time.monotonic()
+    futures = [scheduler.submit(chat_id, bot.send_message, chat_id, "hi")
+               for chat_id in range(30)]
+    done, _ = wait(futures, timeout=10)
+    elapsed = time.monotonic() - started
+
+    assert len(done) == 30
+    assert all(f.exception() is None for f in futures)
+    assert bot.rejected == 0
+    # 10 go out at once, the other 20 at 10 per second
+    assert elapsed >= 1.8
+
+def test_chat_rate_is_respected_without_delaying_other_chats():
+    bot = FakeBot(enforce_limits=True, chat_interval=0.3)
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=5, chat_burst=1)
+    busy = [scheduler.submit(1, bot.send_message, 1, "hi") for _ in range(5)]
+    other = scheduler.submit(2, bot.send_message, 2, "hi")
+
+    other.result(timeout=1)
+    assert not busy[-1].done()
+    wait(busy, timeout=5)
+    assert all(f.exception() is None for f in busy)
+    assert bot.rejected == 0
+
+def test_interactive_calls_jump_ahead_of_bulk():
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+    started, gate = threading.Event(), threading.Event()
+    order = []
+
+    def block():
+        started.set()
+        gate.wait(5)
+
+    scheduler.submit(None, block)
+    assert started.wait(1)
+    bulk = [scheduler.submit(1, order.append, f"bulk{i}", priority=bot_module.PRIORITY_BULK)
+            for i in range(3)]
+    interactive = scheduler.submit(2, order.append, "interactive")
+    gate.set()
+    wait(bulk + [interactive], timeout=5)
+
+    assert order == ["interactive", "bulk0", "bulk1", "bulk2"]
+
+def test_flood_control_is_retried():
+    bot = FakeBot(enforce_limits=True, chat_interval=0)
+    bot._window = [time.monotonic()] * bot.global_rate
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+    future = scheduler.submit(1, bot.send_message, 1, "hi")
+
+    assert future.result(timeout=5) is not None
+    assert bot.rejected == 1
+    assert bot.calls == 1
+
+def test_failed_call_reports_to_on_error():
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+    errors = []
+
+    def fail():
+        raise ValueError("bad request")
+
+    future = scheduler.submit(1, fail, on_error=errors.append)
+    wait([future], timeout=5)
+
+    assert isinstance(future.exception(), ValueError)
+    assert [str(e) for e in errors] == ["bad request"]
+
+class RejectingMarkdownBot(FakeBot):
+    """Fails MarkdownV2 messages the way Telegram does for bad entities."""
+
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        if kwargs.get("parse_mode") == "MarkdownV2":
+            raise ValueError("Can't parse entities")
+        self.texts.append(text)
+        return super().send_message(chat_id, text, *args, **kwargs)
+
+def test_pending_reply_sends_error_when_answer_fails():
+    bot = RejectingMarkdownBot()
+    update = make_update(bot, 1, 4242, "/rates")
+    bot_module.PendingReply(update).send_markdown("*rates*")
+
+    deadline = time.monotonic() + 5
+    while not bot.texts and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert bot.texts == [bot_module.SEND_FAILED_TEXT]
+
+def test_calls_to_different_chats_are_sent_in_parallel():
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000,
+                                             workers=10)
+    started = time.monotonic()
+    futures = [scheduler.submit(chat_id, time.sleep, 0.1) for chat_id in range(30)]
+    wait(futures, timeout=10)
+    elapsed = time.monotonic() - started
+
+    # ceil(30 / 10) round trips of 100 ms
+    assert all(f.done() for f in futures)
+    assert 0.3 <= elapsed < 0.6
+
+def test_calls_to_one_chat_stay_in_order():
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000,
+                                             workers=4)
+    order = []
+
+    def send(i):
+        time.sleep(0.01 * (5 - i))
+        order.append(i)
+
+    wait([scheduler.submit(1, send, i) for i in range(5)], timeout=5)
+    assert order == [0, 1, 2, 3, 4]
+
+def test_flood_control_pauses_the_whole_bot():
+    scheduler = bot_module.OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+    failed = threading.Event()
+
+    def flooded():
+        if not failed.is_set():
+            failed.set()
+            raise FakeRetryAfter(0.5)
+        return "sent"
+
+    first = scheduler.submit(1, flooded)
+    assert failed.wait(1)
+    # Give the sender thread a moment to handle the RetryAfter
+    deadline = time.monotonic() + 1
+    while not scheduler.global_buckets[None].blocked_until and time.monotonic() < deadline:
+        time.sleep(0.005)
+    started = time.monotonic()
+    other = scheduler.submit(2, lambda: "sent")
+
+    assert other.result(timeout=5) == "sent"
+    assert time.monotonic() - started >= 0.4
+    assert first.result(timeout=5) == "sent"
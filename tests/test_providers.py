@@ -0,0 +1,118 @@
+"""Hedging, failover and health tracking against local stub rate servers."""
+import time
+
+import pytest
+
+import currenzbot_full as bot_module
+from benchmark import start_stub_server
+
+# Nothing listens here, so requests fail straight away
+DEAD_URL = "http://127.0.0.1:9/v6/latest/"
+
+def stub_url(server):
+    return "http://{}:{}/v6/latest/".format(*server.server_address)
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(latency):
+        server = start_stub_server(latency)
+        started.append(server)
+        return stub_url(server)
+
+    yield start
+    for server in started:
+        server.shutdown()
+
+@pytest.fixture
+def use_providers(monkeypatch):
+    monkeypatch.setattr(bot_module, "PROVIDER_EXPLORE_RATE", 0)
+    monkeypatch.setattr(bot_module, "PROVIDER_PROBE_INTERVAL", 60)
+
+    def install(*urls):
+        providers = [bot_module.RateProvider(f"stub_{i}", url, bot_module.parse_open_er_api)
+                     for i, url in enumerate(urls)]
+        pool = bot_module.ProviderPool(providers)
+        monkeypatch.setattr(bot_module, "rate_providers", pool)
+        return providers
+
+    return install
+
+def test_slow_provider_is_hedged_from_the_first_request(servers, use_providers):
+    slow, fast = use_providers(servers(1.5), servers(0.01))
+    hedges = bot_module.UPSTREAM_HEDGES.value("hedge")
+
+    started = time.perf_counter()
+    rates = bot_module.fetch_exchange_rates("EUR")
+    elapsed = time.perf_counter() - started
+
+    assert rates["EUR"] == pytest.approx(1.0)
+    assert elapsed < 1.0
+    assert bot_module.UPSTREAM_HEDGES.value("hedge") == hedges + 1
+    assert len(fast.latencies) == 1
+
+def test_failed_provider_fails_over_to_the_next(servers, use_providers):
+    dead, live = use_providers(DEAD_URL, servers(0.01))
+    failovers = bot_module.UPSTREAM_HEDGES.value("failover")
+
+    rates = bot_module.fetch_exchange_rates("USD")
+
+    assert rates["USD"] == pytest.approx(1.0)
+    assert bot_module.UPSTREAM_HEDGES.value("failover") == failovers + 1
+    assert list(dead.outcomes) == [False]
+    assert list(live.outcomes) == [True]
+
+def test_failing_provider_is_marked_unhealthy_and_ranked_last(servers, use_providers):
+    dead, live = use_providers(DEAD_URL, servers(0.01))
+    assert bot_module.fetch_exchange_rates("USD")
+
+    status = bot_module.rate_providers.status()
+    assert status["stub_0"]["healthy"] is False
+    assert status["stub_1"]["healthy"] is True
+    assert bot_module.rate_providers.ranked() == [live, dead]
+
+    # Once ranked last, the unhealthy provider is no longer asked first
+    for _ in range(3):
+        assert bot_module.fetch_exchange_rates("USD")
+    assert len(dead.outcomes) == 1
+    assert len(live.outcomes) == 4
+
+def test_unhealthy_provider_is_probed_again_from_any_rank(servers, use_providers, monkeypatch):
+    fast, slow, dead = use_providers(servers(0.01), servers(0.01), DEAD_URL)
+    dead.outcomes.append(False)
+    dead.last_attempt = time.monotonic()
+    assert bot_module.rate_providers.ranked()[-1] is dead
+
+    monkeypatch.setattr(bot_module, "PROVIDER_PROBE_INTERVAL", 0.05)
+    time.sleep(0.1)
+    assert bot_module.rate_providers.ranked()[0] is dead
+    # The probe is claimed, so the next lookup goes back to the healthy order
+    assert bot_module.rate_providers.ranked()[-1] is dead
+
+    dead.url = fast.url
+    time.sleep(0.1)
+    assert bot_module.fetch_exchange_rates("USD")
+    assert list(dead.outcomes) == [False, True]
+
+def test_p95_of_few_samples_stays_in_range():
+    provider = bot_module.RateProvider("stub", DEAD_URL, bot_module.parse_open_er_api)
+    provider.latencies.extend([0.5, 0.1, 0.2, 0.4, 0.3])
+    assert provider.p95() == 0.5
+
+def test_no_provider_answering_returns_none(use_providers):
+    use_providers(DEAD_URL, DEAD_URL)
+    assert bot_module.fetch_exchange_rates("USD") is None
+
+def test_quota_report_is_reused_briefly_and_shared_between_processes(tmp_path):
+    path = str(tmp_path / "quota.db")
+    worker = bot_module.UpstreamQuota(bot_module.SQLiteBackend(path), limit=10, status_interval=60)
+    other = bot_module.UpstreamQuota(bot_module.SQLiteBackend(path), limit=10, status_interval=0)
+    worker.record("stub")
+    first = worker.status()
+    assert (first["used"], first["remaining"]) == (1, 9)
+
+    other.record("stub")
+    assert worker.status() is first
+    assert worker.last_status() is first
+    assert other.status()["used"] == 2
@@ -0,0 +1,86 @@
+"""State backends and the stores built on them."""
+import time
+
+import pytest
+
+import currenzbot_full as bot_module
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return bot_module.MemoryBackend()
+    return bot_module.SQLiteBackend(str(tmp_path / "state.db"))
+
+def test_count_skips_expired_values_and_tombstones(backend):
+    backend.set("ns", "live", 1)
+    backend.set("ns", "expiring", 2, ttl=0.05)
+    backend.update_many("ns", ["gone"], lambda values: {"gone": 3})
+    backend.update_many("ns", ["gone"], lambda values: {"gone": None})
+    assert backend.count("ns") == 2
+
+    time.sleep(0.1)
+    assert backend.count("ns") == 1
+    assert backend.get("ns", "expiring") is None
+
+def test_changes_report_deletes_after_a_version(backend):
+    backend.update_many("ns", [], lambda values: {"a": 1, "b": 2})
+    _, version = backend.changes("ns")
+    backend.update_many("ns", ["a"], lambda values: {"a": None})
+
+    rows, latest = backend.changes("ns", version)
+    assert rows == [("a", None)]
+    assert latest > version
+
+def test_values_are_copied_in_and_out(backend):
+    value = {"rates": {"USD": 1.0}}
+    backend.set("ns", "key", value)
+    value["rates"]["USD"] = 2.0
+    backend.get("ns", "key")["rates"]["USD"] = 3.0
+    assert backend.get("ns", "key") == {"rates": {"USD": 1.0}}
+
+def test_conversation_store_drops_least_recently_used(backend):
+    store = bot_module.ConversationStateStore(max_size=2, backend=backend)
+    for user_id in (1, 2, 3):
+        store.start(user_id)
+        time.sleep(0.001)
+    assert len(store) == 2
+    assert 1 not in store
+
+    state = store.get(2)
+    state.base_currency = "EUR"
+    store.save(2, state)
+    store.start(4)
+    assert 3 not in store
+    assert store.get(2).base_currency == "EUR"
+
+def test_analytics_survive_a_restart_without_a_shared_backend():
+    analytics = bot_module.BotAnalytics(backend=bot_module.MemoryBackend(), name="restart")
+    analytics.track_user(42, username="alice")
+    analytics.track_command("start", user_id=42)
+
+    reloaded = bot_module.BotAnalytics(backend=bot_module.MemoryBackend(), name="restart")
+    assert reloaded.data["users"]["42"]["username"] == "alice"
+    assert reloaded.data["commands"]["start"]["count"] == 1
+
+def test_rate_cache_sees_rates_cached_by_another_process(tmp_path):
+    path = str(tmp_path / "state.db")
+    fetcher = bot_module.RateCache(backend=bot_module.SQLiteBackend(path))
+    reader = bot_module.RateCache(backend=bot_module.SQLiteBackend(path))
+    lookups = {outcome: bot_module.RATE_CACHE_LOOKUPS.value(outcome)
+               for outcome in ("hit", "shared_hit", "miss")}
+
+    assert not reader.contains("EUR")
+    fetcher.set("EUR", {"EUR": 1.0, "USD": 1.1})
+    assert reader.contains("EUR")
+    assert reader.peek("EUR") == {"EUR": 1.0, "USD": 1.1}
+    # Neither check counts as a cache lookup
+    assert {outcome: bot_module.RATE_CACHE_LOOKUPS.value(outcome) for outcome in lookups} == lookups
+
+def test_tenant_analytics_are_created_on_first_use():
+    tenant = bot_module.BotTenant("lazy", "token")
+    assert tenant._analytics is None
+    assert "analytics_users:lazy" not in bot_module.memory_monitor.structures
+
+    assert tenant.analytics is tenant.analytics
+    assert bot_module.memory_monitor.structures["analytics_users:lazy"]() == 0
+    assert "conversations:lazy" in bot_module.memory_monitor.structures